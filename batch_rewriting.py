@@ -1,40 +1,186 @@
-from cqapk_to_datalog.rewriting import rewrite
-from cqapk_to_datalog.parsers.cq_parser import parse_queries_from_file
+from cqapk_to_datalog.rewriting import rewrite_many, write_rewriting
+from cqapk_to_datalog.parsers.cq_parser import read_queries_from_file, parse_query
+from cqapk_to_datalog.exceptions import CoNPComplete, NotSelfJoinFreeQuery, MalformedQuery
+from cqapk_to_datalog.instrumentation import collect_stats
 import sys
 
-def format_output(q):
+def format_header(q):
     free = ""
     if len(q.free_vars) > 0:
         free = "("+",".join(map(lambda x : x.name, q.free_vars))+")"
-    output = "\n% Datalog rewriting of CERTAINTY(q"+free+") with q = "+str(q)+"\n"
-    output += str(rewrite(q))
+    return "\n% Datalog rewriting of CERTAINTY(q"+free+") with q = "+str(q)+"\n"
+
+
+def format_output(result):
+    if result.query is None:
+        return "\n% " + str(result.error) + "\n"
+    output = format_header(result.query)
+    if result.error is not None:
+        output += "% " + str(result.error) + "\n"
+    else:
+        output += str(result.program)
+    if result.stats is not None:
+        output += format_stats(result.stats)
     return output
 
 
+def format_stats(stats):
+    # The stats are written as Datalog comments
+    return "".join("% " + line + "\n" for line in str(stats).split("\n"))
+
+
+def format_json(result):
+    # One JSON object per line, with the metadata of the rewriting
+    import json
+    record = {"input": str(result.source), "query": None, "free_variables": None,
+              "classification": result.complexity, "rules": None, "time": result.time, "program": None, "error": None}
+    if result.query is not None:
+        record["query"] = str(result.query)
+        record["free_variables"] = [var.name for var in result.query.free_vars]
+    if result.error is not None:
+        record["error"] = str(result.error)
+    else:
+        record["rules"] = len(result.program.rules)
+        record["program"] = [str(rule) for rule in result.program.rules]
+    if result.stats is not None:
+        record["stats"] = result.stats.to_dict()
+    return json.dumps(record) + "\n"
+
+
+def format_result(result, formatter=format_output):
+    # Applied in the worker processes : only the text of the output and the error are sent back
+    error = None
+    if result.error is not None:
+        error = str(result.source) + " : " + str(result.error)
+    return formatter(result), error
+
+
+def format_json_result(result):
+    return format_result(result, format_json)
+
+
+def report_error(error):
+    # Failures are also reported on stderr so that they are not lost in the output file
+    if error is not None:
+        print("Error : " + error, file=sys.stderr)
+
+
+def write_output(query, file, stats=False):
+    # Writes the rewriting of a query rule by rule as it is generated (Same output as format_output)
+    if stats:
+        with collect_stats() as collected:
+            write_output(query, file)
+        file.write(format_stats(collected))
+        return
+    try:
+        q = parse_query(query)
+    except MalformedQuery as error:
+        report_error(query + " : " + str(error))
+        file.write("\n% " + str(error) + "\n")
+        return
+    file.write(format_header(q))
+    try:
+        write_rewriting(q, file)
+    except (NotSelfJoinFreeQuery, CoNPComplete) as error:
+        report_error(query + " : " + str(error))
+        file.write("% " + str(error) + "\n")
+
+
+def open_output(file):
+    # The output is compressed according to the extension of the file (.gz or .zst)
+    if file.endswith(".gz"):
+        import gzip
+        return gzip.open(file, "wt")
+    if file.endswith(".zst"):
+        try:
+            from compression import zstd
+        except ImportError:
+            print("zstd compression needs Python 3.14 or later", file=sys.stderr)
+            sys.exit(1)
+        return zstd.open(file, "wt")
+    return open(file, "w")
+
+
 class PrintOutput:
-    def save(self, queries):
-        for q in queries:
-            print(format_output(q))
+    def __init__(self, end="\n"):
+        self.end = end
+    def save(self, outputs):
+        for output, error in outputs:
+            report_error(error)
+            sys.stdout.write(output + self.end)
+            sys.stdout.flush()
+    def stream(self, queries, stats=False):
+        for query in queries:
+            write_output(query, sys.stdout, stats)
+            sys.stdout.write(self.end)
+            sys.stdout.flush()
 
 class FileOutput:
     def __init__(self, file):
         self.file = file
-    def save(self, queries):
-        file = open(self.file, 'w+')
-        for q in queries:
-            file.write(format_output(q))
-
-if len(sys.argv) < 2:
-    print("Please give a valid file as input")
-else:
-    file = sys.argv[1]
-    output = None
-    if len(sys.argv) >= 3:
-        output_file = sys.argv[2]
-        output = FileOutput(output_file)
-    else:
-        output = PrintOutput()
-    queries = parse_queries_from_file(file)
-    output.save(queries)
+    def save(self, outputs):
+        # Each rewriting is written (and flushed) as soon as it is ready
+        with open_output(self.file) as file:
+            for output, error in outputs:
+                report_error(error)
+                file.write(output)
+                file.flush()
+    def stream(self, queries, stats=False):
+        with open_output(self.file) as file:
+            for query in queries:
+                write_output(query, file, stats)
+                file.flush()
+
+
+def pop_option(args, name):
+    # Removes "name value" from args and returns value (None if the option is not given)
+    if name not in args:
+        return None
+    i = args.index(name)
+    value = args[i + 1] if i + 1 < len(args) else None
+    del args[i:i + 2]
+    return value
 
 
+def pop_flag(args, name):
+    # Removes name from args and returns True if it was given
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    cache = None
+    # --cache cache_file : rewritings are loaded from (and stored into) a persistent cache
+    cache_file = pop_option(args, "--cache")
+    if cache_file is not None:
+        from cqapk_to_datalog.cache import DiskCache
+        cache = DiskCache(cache_file)
+    # --workers N : queries are rewritten by N processes
+    workers = pop_option(args, "--workers")
+    workers = int(workers) if workers is not None else 1
+    # --jsonl : one JSON object (rewriting and metadata) per query
+    jsonl = pop_flag(args, "--jsonl")
+    formatter = format_json_result if jsonl else format_result
+    # --stats : the time spent in each phase of the rewriting is written with each query
+    stats = pop_flag(args, "--stats")
+    if len(args) < 1:
+        print("Please give a valid file as input")
+    else:
+        file = args[0]
+        output = None
+        if len(args) >= 2:
+            output_file = args[1]
+            output = FileOutput(output_file)
+        else:
+            output = PrintOutput("" if jsonl else "\n")
+        queries = read_queries_from_file(file)
+        if workers <= 1 and cache is None and not jsonl:
+            # The rules are written as they are generated, without building the programs
+            output.stream(queries, stats)
+        else:
+            output.save(rewrite_many(queries, workers, cache, formatter, stats))
+    if cache is not None:
+        cache.close()
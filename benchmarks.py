@@ -0,0 +1,114 @@
+from cqapk_to_datalog.data_structures import AtomValue, Atom, FunctionalDependency, FunctionalDependencySet, \
+    ConjunctiveQuery
+import cqapk_to_datalog.algorithms as algorithms
+from cqapk_to_datalog.rewriting import rewrite
+from cqapk_to_datalog.cache import DiskCache
+import tempfile
+import os
+import subprocess
+import time
+import sys
+
+# Modules imported by batch_rewriting.py
+CLI_MODULES = ["cqapk_to_datalog.rewriting", "cqapk_to_datalog.parsers.cq_parser"]
+# Maximal cumulative import time of CLI_MODULES (in seconds)
+IMPORT_TIME_BUDGET = 0.1
+# Dependencies that must not be loaded when CLI_MODULES are imported
+HEAVY_MODULES = ["networkx", "regex", "pandas", "matplotlib"]
+
+
+def dense_scc_query(n):
+    """
+    Query R_i([X_i], X_0, ..., X_n-1) (without X_i in the non key part) whose attack graph is a complete graph on n atoms
+    ie. a single strongly connected component containing exponentially many simple cycles
+    """
+    variables = [AtomValue("X_" + str(i), True) for i in range(n)]
+    content = {}
+    for i in range(n):
+        others = variables[:i] + variables[i + 1:]
+        fd = FunctionalDependencySet([FunctionalDependency([variables[i]], var) for var in others])
+        atom = Atom("R_" + str(i), [variables[i]] + others)
+        content[atom] = (fd, [True] + [False] * len(others), False)
+    return ConjunctiveQuery(content)
+
+
+def cyclic_query(n):
+    """
+    Query R_0([X_0], X_1), ..., R_n-1([X_n-1], X_0) whose rewriting needs the reduction of a cycle of n atoms
+    """
+    variables = [AtomValue("X_" + str(i), True) for i in range(n)]
+    content = {}
+    for i in range(n):
+        x, y = variables[i], variables[(i + 1) % n]
+        content[Atom("R_" + str(i), [x, y])] = (FunctionalDependencySet([FunctionalDependency([x], y)]), [True, False],
+                                                 False)
+    return ConjunctiveQuery(content)
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    res = f(*args)
+    return res, time.perf_counter() - start
+
+
+def bench_dense_scc(max_n):
+    """
+    Time needed to build the attack graph and to decide whether all its cycles are weak on dense components
+    """
+    for n in range(2, max_n + 1):
+        q = dense_scc_query(n)
+        a_graph, graph_time = timed(algorithms.gen_attack_graph, q)
+        weak, weak_time = timed(algorithms.all_cycles_weak, a_graph, q)
+        print("n=%d edges=%d weak=%s attack_graph=%.4fs all_cycles_weak=%.4fs" %
+              (n, len(a_graph.edges), weak, graph_time, weak_time))
+
+
+def bench_disk_cache(max_n):
+    """
+    Time needed to rewrite cyclic queries compared to the time needed to load their rewriting from a DiskCache
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(os.path.join(directory, "cache.sqlite"))
+        for n in range(2, max_n + 1):
+            q = cyclic_query(n)
+            program, rewrite_time = timed(rewrite, q, cache)
+            cached, load_time = timed(rewrite, q, cache)
+            print("n=%d rules=%d rewrite=%.4fs cached=%.4fs" % (n, len(program.rules), rewrite_time, load_time))
+        cache.close()
+
+
+def import_times(modules):
+    """
+    Imports the given modules in a fresh interpreter with -X importtime
+    :return:    A dict mapping each imported module to its cumulative import time (in seconds)
+    """
+    code = "; ".join("import " + module for module in modules)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def bench_import_time():
+    """
+    Cumulative import time of the modules used by the command line tool, compared to IMPORT_TIME_BUDGET
+    """
+    times = import_times(CLI_MODULES)
+    total = sum(times[module] for module in CLI_MODULES if module in times)
+    heavy = [module for module in HEAVY_MODULES if module in times]
+    print("import time=%.4fs budget=%.4fs heavy modules=%s" % (total, IMPORT_TIME_BUDGET, heavy))
+    return total, heavy
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "import":
+        bench_import_time()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "cache":
+        bench_disk_cache(int(sys.argv[2]) if len(sys.argv) >= 3 else 8)
+    else:
+        bench_dense_scc(int(sys.argv[1]) if len(sys.argv) >= 2 else 40)
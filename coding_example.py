@@ -1,4 +1,4 @@
-from cqapk_to_datalog.rewriting import rewrite
+from cqapk_to_datalog.rewriting import rewrite, classify
 from cqapk_to_datalog.data_structures import AtomValue, Atom, ConjunctiveQuery, FunctionalDependency, FunctionalDependencySet
 
 # Initialize variables and constants
@@ -40,6 +40,12 @@ q = q.release_variable(x)
 q = q.release_variable(y)
 
 
+# Classify CERTAINTY(q) without generating the Datalog program
+#       complexity :            FO, L or coNP-complete
+#       elimination_order :     The atoms in the order in which they are rewritten
+#       cycles :                The cycles reduced during the rewriting
+print(classify(q))
+
 # Launch rewriting
 program = rewrite(q)
 
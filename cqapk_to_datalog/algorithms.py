@@ -1,7 +1,9 @@
-import networkx as nx
-from typing import Set, List, FrozenSet, Dict
+from collections import Counter
+from typing import Set, List, FrozenSet, Dict, Iterable, Iterator, Callable
 from cqapk_to_datalog.data_structures import AtomValue, Atom, FunctionalDependency, ConjunctiveQuery, SequentialProof, \
-    FunctionalDependencySet
+    FunctionalDependencySet, CompiledFunctionalDependencySet
+from cqapk_to_datalog.graph import DiGraph
+from cqapk_to_datalog.instrumentation import phase, counted, add_counters
 
 
 def generate_new_variables(base: str, n: int, index: int) -> List[AtomValue]:
@@ -87,14 +89,7 @@ def transitive_closure(var: Set[AtomValue], fd_set: FunctionalDependencySet) ->
     :param fd_set:      Set of FD
     :return:            The transitive closure of var using fd_set
     """
-    closure = var.copy()
-    size = 0
-    while len(closure) != size:
-        size = len(closure)
-        for fd in fd_set.set:
-            if all(v in closure for v in fd.left) and fd.right not in closure:
-                closure.add(fd.right)
-    return closure
+    return fd_set.compile().closure(var)
 
 
 def atom_plus(atom: Atom, q: ConjunctiveQuery) -> Set[AtomValue]:
@@ -105,74 +100,191 @@ def atom_plus(atom: Atom, q: ConjunctiveQuery) -> Set[AtomValue]:
     :return:            The plus q set of variables of atom
     """
     if q.is_atom_consistent(atom):
-        return transitive_closure(set(q.get_key_vars(atom)), q.get_all_fd())
+        return q.get_compiled_fd().closure(q.get_key_vars(atom))
     else:
-        return transitive_closure(set(q.get_key_vars(atom)), q.get_all_fd(atom))
+        return q.get_compiled_fd().closure(q.get_key_vars(atom), atom)
 
 
-def gen_attack_graph(q: ConjunctiveQuery) -> nx.DiGraph:
+@phase("gen_attack_graph")
+def gen_attack_graph(q: ConjunctiveQuery) -> 'AttackGraph':
     """
     Computes the attack graph of a given ConjunctiveQuery q.
     :param q:   A ConjunctiveQuery
     :return:    Generated Attack Graph
     """
-    g = nx.DiGraph()
-    atoms = q.get_atoms()
-    for atom in atoms:
-        g.add_node(atom)
-    for atom in atoms:
-        plus = atom_plus(atom, q)
-        reachable = {atom}
-        candidates = atoms - {atom}
-        size = -1
-        while len(reachable) != size:
-            size = len(reachable)
-            new_reachable = set()
-            for atom1 in reachable:
-                for atom2 in candidates:
-                    intersection = set(atom1.variables()).intersection(set(atom2.variables()))
-                    without_plus = intersection - plus
-                    if without_plus:
-                        new_reachable.add(atom2)
-            reachable = reachable.union(new_reachable)
-            candidates = candidates - new_reachable
-        for other in reachable - {atom}:
-            g.add_edge(atom, other)
-    return g
+    return AttackGraph(q)
 
 
-def gen_m_graph(q: ConjunctiveQuery) -> nx.DiGraph:
+def attacked_atoms(atom: Atom, q: ConjunctiveQuery, plus: Set[AtomValue] = None) -> Set[Atom]:
+    """
+    Computes the atoms reachable from a given atom through variables that are not in its plus set ie. the atoms it
+    attacks (and the atom itself). This is a BFS over the variable -> atoms incidence index of q.
+    :param atom:        An Atom
+    :param q:           A ConjunctiveQuery
+    :param plus:        The plus q set of atom (Computed if not given)
+    :return:            A set containing atom and all the atoms it attacks
+    """
+    seen = set(atom_plus(atom, q) if plus is None else plus)
+    reachable = {atom}
+    to_visit = [atom]
+    while to_visit:
+        current = to_visit.pop()
+        for var in current.variables():
+            if var not in seen:
+                seen.add(var)
+                for other in q.get_atoms_with_variable(var):
+                    if other not in reachable:
+                        reachable.add(other)
+                        to_visit.append(other)
+    return reachable
+
+
+class AttackGraph(DiGraph):
+    """
+    Attack graph of a ConjunctiveQuery. Besides the edges, the plus set and the attacked atoms of every atom are kept
+    so that the graph can be updated in place when the query is modified by a rewriting step (See update).
+    """
+
+    def __init__(self, q: ConjunctiveQuery = None) -> None:
+        """
+        Constructor
+        :param q:       A ConjunctiveQuery (The graph is empty if None)
+        """
+        DiGraph.__init__(self)
+        self.q = q
+        self.plus = {}
+        self.attacked = {}
+        if q is not None:
+            atoms = q.get_atoms()
+            for atom in atoms:
+                self.add_node(atom)
+            for atom in atoms:
+                self._compute(atom)
+
+    def _compute(self, atom: Atom) -> None:
+        """
+        Computes the plus set and the attacked atoms of an atom of the current query and adds the corresponding edges
+        :param atom:    An Atom
+        """
+        plus = atom_plus(atom, self.q)
+        attacked = attacked_atoms(atom, self.q, plus) - {atom}
+        self.plus[atom] = plus
+        self.attacked[atom] = attacked
+        for other in attacked:
+            self.add_edge(atom, other)
+
+    @phase("update_attack_graph")
+    def update(self, q: ConjunctiveQuery) -> None:
+        """
+        Updates the graph so that it becomes the attack graph of q, where q has been obtained from the current query by
+        removing atoms, adding atoms and releasing variables (eg. by rewrite_fo, saturate or reduce_cycle).
+        Only the atoms whose plus set or attacked atoms may have changed are recomputed.
+        :param q:           The new ConjunctiveQuery
+        """
+        old_q = self.q
+        old_atoms = old_q.get_atoms()
+        new_atoms = q.get_atoms()
+        removed = old_atoms - new_atoms
+        added = new_atoms - old_atoms
+        old_free = set(old_q.free_vars)
+        released = set(var for var in q.free_vars if var not in old_free)
+        affected = set()
+        # Attacks going through a removed atom, a released variable or a variable of an added atom
+        for atom in removed:
+            affected.update(self.predecessors(atom))
+        affected.difference_update(removed)
+        touched = released.union(*[atom.variables() for atom in added])
+        for var in touched:
+            for atom in old_q.get_atoms_with_variable(var):
+                for source in [atom] + list(self.predecessors(atom)):
+                    if source not in removed and var not in self.plus[source]:
+                        affected.add(source)
+        # Plus sets that may change. The plus set of an atom becomes its old plus set without the released variables
+        # unless a removed FD takes part in it or a remaining or added FD can extend it once the variables are released.
+        compiled = old_q.get_compiled_fd()
+        new_compiled = q.get_compiled_fd()
+        removed_owners = set(compiled.owner_ids[atom] for atom in removed if atom in compiled.owner_ids)
+        removed_fds = [i for i in range(len(compiled.lefts)) if compiled.owners[i] in removed_owners]
+        added_owners = set(new_compiled.owner_ids[atom] for atom in added if atom in new_compiled.owner_ids)
+        added_fds = [i for i in range(len(new_compiled.lefts)) if new_compiled.owners[i] in added_owners]
+        released_mask = compiled.mask(released)
+        released_fds = set()
+        for b in compiled.mask_bits(released_mask):
+            released_fds.update(compiled.watchers[b])
+        released_fds.difference_update(removed_fds)
+        new_released_mask = new_compiled.mask(released)
+        for atom in old_atoms - removed - affected:
+            if not released.isdisjoint(old_q.content[atom].key_vars):
+                affected.add(atom)
+                continue
+            excluded = -2 if old_q.is_atom_consistent(atom) else compiled.owner_ids.get(atom, -2)
+            plus_mask = compiled.mask(self.plus[atom])
+            known_mask = plus_mask | released_mask
+            new_known_mask = new_compiled.mask(self.plus[atom]) | new_released_mask
+            if any(compiled.lefts[i] & ~plus_mask == 0 and (plus_mask & ~released_mask) >> compiled.rights[i] & 1
+                   for i in removed_fds) or \
+                    any(compiled.owners[i] != excluded and compiled.lefts[i] & ~known_mask == 0
+                        and not known_mask >> compiled.rights[i] & 1 for i in released_fds) or \
+                    any(new_compiled.lefts[i] & ~new_known_mask == 0 and not new_known_mask >> new_compiled.rights[i] & 1
+                        for i in added_fds):
+                affected.add(atom)
+        self.q = q
+        for atom in removed:
+            self.remove_node(atom)
+            del self.plus[atom]
+            del self.attacked[atom]
+        for atom in old_atoms - removed:
+            if atom in affected:
+                for other in self.attacked[atom] - removed:
+                    self.remove_edge(atom, other)
+            else:
+                self.plus[atom] = self.plus[atom] - released
+        for atom in added:
+            self.add_node(atom)
+        for atom in affected | added:
+            self._compute(atom)
+
+
+@phase("gen_m_graph")
+def gen_m_graph(q: ConjunctiveQuery, atoms: Iterable[Atom] = None) -> DiGraph:
     """
     Computes the M-graph of a given ConjunctiveQuery q.
-    :param q:   A ConjunctiveQuery
-    :return:    Generated M-Graph
-    """
-    atoms = q.get_atoms()
-    g = nx.DiGraph()
-    for atom1 in atoms:
-        g.add_node(atom1)
-        closure = transitive_closure(set(atom1.variables()), q.get_consistent_fd())
-        for atom2 in [atom for atom in atoms if atom != atom1]:
-            if set(q.get_key_vars(atom2)).issubset(closure):
-                g.add_edge(atom1, atom2)
+    :param q:       A ConjunctiveQuery
+    :param atoms:   If given, only the subgraph induced by these atoms is computed
+    :return:        Generated M-Graph
+    """
+    atoms = list(q.get_atoms() if atoms is None else [atom for atom in atoms if atom in q.content])
+    g = DiGraph()
+    compiled = q.get_compiled_fd(True)
+    keys = [compiled.mask(q.content[atom].key_vars) for atom in atoms]
+    closures = compiled.closure_masks([compiled.mask(atom.variables()) for atom in atoms])
+    for i in range(len(atoms)):
+        g.add_node(atoms[i])
+        for j in range(len(atoms)):
+            if i != j and keys[j] & ~closures[i] == 0:
+                g.add_edge(atoms[i], atoms[j])
     return g
 
 
-def all_cycles_weak(attack_graph: nx.DiGraph, q: ConjunctiveQuery) -> bool:
+@phase("all_cycles_weak")
+def all_cycles_weak(attack_graph: DiGraph, q: ConjunctiveQuery) -> bool:
     """
-    Returns True if the given Attack Graph contains no strong cycle
+    Returns True if the given Attack Graph contains no strong cycle.
+    Every edge between two atoms of the same strongly connected component lies on a cycle, so a strong cycle exists
+    iff there is a strong edge inside a strongly connected component. The closure of each key is computed only once.
     :param attack_graph:    An Attack Graph
     :param q:               A ConjunctiveQuery
     :return:                True if attack_graph contains no strong cycle, False if not
     """
-    cycles = nx.algorithms.simple_cycles(attack_graph)
-    for cycle in cycles:
-        full_cycle = cycle + [cycle[0]]
-        for i in range(0, len(cycle)):
-            atom1 = full_cycle[i]
-            atom2 = full_cycle[i + 1]
-            for var in q.get_key_vars(atom2):
-                if var not in transitive_closure(set(q.get_key_vars(atom1)), q.get_all_fd()):
+    compiled = q.get_compiled_fd()
+    for component in attack_graph.strongly_connected_components():
+        if len(component) < 2:
+            continue
+        closures = {atom: compiled.closure(q.get_key_vars(atom)) for atom in component}
+        for atom1 in component:
+            closure = closures[atom1]
+            for atom2 in attack_graph.successors(atom1):
+                if atom2 in component and not closure.issuperset(q.get_key_vars(atom2)):
                     return False
     return True
 
@@ -185,134 +297,219 @@ def atom_attacks_variables(atom: Atom, var: AtomValue, q: ConjunctiveQuery) -> b
     :param q:           A ConjunctiveQuery
     :return:            True if atom attacks var, else returns False
     """
-    n = Atom("N", [var])
-    q_new = q.add_atom(n, FunctionalDependencySet(), [True], False)
-    g = gen_attack_graph(q_new)
-    return g.has_edge(atom, n)
+    plus = atom_plus(atom, q)
+    return var.var and var not in plus and \
+        any(var in other.variables() for other in attacked_atoms(atom, q, plus))
+
+
+def attacked_variables(q: ConjunctiveQuery, a_graph: 'AttackGraph' = None) -> Dict[Atom, Set[AtomValue]]:
+    """
+    Computes, for every atom of q, the variables it attacks ie. the variables that are not in its plus set and that
+    belong to the atom itself or to an atom it attacks.
+    :param q:           A ConjunctiveQuery
+    :param a_graph:     The AttackGraph of q (Computed if not given)
+    :return:            A Dict that maps each atom to the set of variables it attacks
+    """
+    if a_graph is None:
+        a_graph = AttackGraph(q)
+    res = {}
+    for atom in q.get_atoms():
+        variables = set(atom.variables())
+        for other in a_graph.attacked[atom]:
+            variables.update(other.variables())
+        res[atom] = variables - a_graph.plus[atom]
+    return res
 
 
-def sequential_proofs(fd: FunctionalDependency, q: ConjunctiveQuery) -> List[SequentialProof]:
+def sequential_proofs(fd: FunctionalDependency, q: ConjunctiveQuery,
+                      accept: Callable[[SequentialProof], bool] = None) -> List[SequentialProof]:
     """
     Returns all the sequential proofs for a given FD. This function returns only elementary sequential proofs ie
     no sequential proof in the set is a subset of another one in the set.
     :param fd :     A FD
     :param q:       A ConjunctiveQuery
+    :param accept:  If given, the search stops at the first sequential proof accepted by this function, which is
+                    then the only element of the returned list (The list is empty if no proof is accepted)
     :return:        A SequentialProof object for fd
     """
     res = []
-    sequential_proof_rec(fd, fd.left, q, [], res)
+    for sp in iter_sequential_proofs(fd, q):
+        if accept is None:
+            res.append(sp)
+        elif accept(sp):
+            return [sp]
     return res
 
 
-def sequential_proof_rec(fd: FunctionalDependency, acc: Set[AtomValue], q: ConjunctiveQuery, current_sp: List[Atom],
-                         current_res: List[SequentialProof]) -> None:
+@counted("sequential_proofs")
+def iter_sequential_proofs(fd: FunctionalDependency, q: ConjunctiveQuery) -> Iterator[SequentialProof]:
     """
-    Recursive function used to compute sequential proofs for a given FD X -> z
-    :param fd:              A FD of the form X -> z
-    :param acc:             A set of Variables containing the variables implied by X with the current sequential proof
-    :param q:               A ConjunctiveQuery
-    :param current_sp:      Current sequential proof
-    :param current_res:     List that will contain all the sequential proofs for X -> z
-    """
-    if fd.right in acc:
-        sequential_proof = SequentialProof(fd, current_sp)
-        to_remove = []
-        for sp in current_res:
-            if sequential_proof.is_subset_of(sp):
-                to_remove.append(sp)
-            elif sp.is_subset_of(sequential_proof):
-                return None
-        for sp in to_remove:
-            current_res.remove(sp)
-        current_res.append(sequential_proof)
-    else:
-        for atom in [atom for atom in q.get_atoms() if atom not in current_sp]:
-            if set(q.get_key_vars(atom)).issubset(acc):
-                sequential_proof_rec(fd, acc.union(set(atom.variables())), q, current_sp + [atom],
-                                     current_res)
+    Yields the elementary sequential proofs of a given FD X -> z by increasing number of steps.
+    The search is a breadth first search over sets of atoms (encoded as bitmasks) : a set of atoms is a state and can be
+    extended with any atom whose key is implied by X and the variables of the atoms in the set. Every state is visited
+    once and the states containing an already found proof are not explored since they can only give non elementary
+    proofs.
+    :param fd:      A FD of the form X -> z
+    :param q:       A ConjunctiveQuery
+    :return:        A generator of SequentialProof objects for fd
+    """
+    atoms = list(q.content)
+    bits = {}
+
+    def mask(variables):
+        m = 0
+        for var in variables:
+            m |= 1 << bits.setdefault(var, len(bits))
+        return m
+
+    start = mask(fd.left)
+    right = 1 << bits.setdefault(fd.right, len(bits))
+    keys = [mask(q.content[atom].key_vars) for atom in atoms]
+    contents = [mask(atom.variables()) for atom in atoms]
+    found = {}
+    level = {0: start}
+    while level:
+        for state, acc in level.items():
+            if acc & right:
+                steps = []
+                remaining = state
+                current = start
+                while remaining:
+                    for i in CompiledFunctionalDependencySet.mask_bits(remaining):
+                        if keys[i] & ~current == 0:
+                            steps.append(atoms[i])
+                            current |= contents[i]
+                            remaining &= ~(1 << i)
+                found.setdefault(state & -state, []).append(state)
+                yield SequentialProof(fd, steps)
+        next_level = {}
+        for state, acc in level.items():
+            if acc & right:
+                continue
+            for i in range(len(atoms)):
+                if not state >> i & 1 and keys[i] & ~acc == 0:
+                    new_state = state | 1 << i
+                    if new_state in next_level or any(proof & ~new_state == 0 for b in found
+                                                       if b & new_state for proof in found[b]):
+                        continue
+                    next_level[new_state] = acc | contents[i]
+        level = next_level
+
+
+def in_one_atom(variables: FrozenSet[AtomValue], q: ConjunctiveQuery) -> bool:
+    """
+    Returns True if some atom of q contains all the given variables
+    :param variables:   A set of Variables
+    :param q:           A ConjunctiveQuery
+    :return:            True if variables are contained in one atom of q, else returns False
+    """
+    if len(variables) == 0:
+        return len(q.content) > 0
+    return any(variables.issubset(atom.variables()) for atom in q.get_atoms_with_variable(next(iter(variables))))
 
 
-def fd_is_internal(fd: FunctionalDependency, q: ConjunctiveQuery) -> bool:
+def fd_is_internal(fd: FunctionalDependency, q: ConjunctiveQuery,
+                   attacks: Dict[Atom, Set[AtomValue]] = None) -> bool:
     """
     Checks if a FD is internal
     :param fd:      A FD
     :param q:       A ConjunctiveQuery
+    :param attacks: The variables attacked by each atom of q (See attacked_variables, computed if not given)
     :return:        True if fd is internal, otherwise returns False
     """
-    in_atom = False
-    atoms = q.get_atoms()
-    for atom in atoms:
-        if fd.left.issubset(set(atom.variables())):
-            in_atom = True
-    if not in_atom:
+    if not in_one_atom(fd.left, q):
         return False
-    sps = sequential_proofs(fd, q)
+    if attacks is None:
+        attacks = attacked_variables(q)
     variables = fd.left.union({fd.right})
-    for sp in sps:
-        valid = True
-        for atom in sp.steps:
-            for var in variables:
-                if atom_attacks_variables(atom, var, q):
-                    valid = False
-        if valid:
-            return True
-    return False
+    return len(sequential_proofs(fd, q, lambda sp: all(attacks[atom].isdisjoint(variables) for atom in sp.steps))) > 0
 
 
-def find_bad_internal_fd(q: ConjunctiveQuery) -> FrozenSet[FunctionalDependency]:
+@phase("find_bad_internal_fd")
+def find_bad_internal_fd(q: ConjunctiveQuery, a_graph: 'AttackGraph' = None) -> FrozenSet[FunctionalDependency]:
     """
     Given a non saturated ConjunctiveQuery, returns the FunctionalDependencies culprit of it's non saturation.
-    :param q:       A ConjunctiveQuery.
-    :return:        A FrozenSet containing the FunctionalDependencies culprit of the non saturation of q.
-    """
-    res = frozenset()
-    possible_starts = []
-    possible_ends = []
+    The candidates X -> z (X a left side and z a right side of FDs of q) are filtered by the cheap tests first : z must
+    not be implied by X using the consistent FDs and X must be contained in one atom. Only the remaining candidates are
+    tested with fd_is_internal. When stats are collected, the number of candidates eliminated by each test is counted
+    (find_bad_internal_fd.closure, .in_atom and .internal) and so is the number of bad FDs (find_bad_internal_fd.bad).
+    :param q:           A ConjunctiveQuery.
+    :param a_graph:     The AttackGraph of q (Computed if needed and not given)
+    :return:            A FrozenSet containing the FunctionalDependencies culprit of the non saturation of q.
+    """
+    res = set()
+    possible_starts = {}
+    possible_ends = {}
     for fd in q.get_all_fd().set:
-        if fd.left not in possible_starts:
-            possible_starts.append(fd.left)
-        if fd.right not in possible_ends:
-            possible_ends.append(fd.right)
+        possible_starts[fd.left] = None
+        possible_ends[fd.right] = None
+    compiled = q.get_compiled_fd(True)
+    attacks = None
+    counters = Counter()
     for left in possible_starts:
+        closure = compiled.closure(left)
+        left_in_atom = in_one_atom(left, q)
         for right in possible_ends:
-            test_fd = FunctionalDependency(left, right)
-            if fd_is_internal(test_fd, q):
-                if right not in transitive_closure(set(left), q.get_consistent_fd()):
-                    res = res.union(frozenset([test_fd]))
-    return res
-
-
-def initial_strong_components(graph: nx.DiGraph) -> List[Set[Atom]]:
+            if right in closure:
+                counters["closure"] += 1
+            elif not left_in_atom:
+                counters["in_atom"] += 1
+            else:
+                if attacks is None:
+                    attacks = attacked_variables(q, a_graph)
+                test_fd = FunctionalDependency(left, right)
+                if fd_is_internal(test_fd, q, attacks):
+                    res.add(test_fd)
+                    counters["bad"] += 1
+                else:
+                    counters["internal"] += 1
+    add_counters("find_bad_internal_fd", counters)
+    return frozenset(res)
+
+
+def initial_strong_components(graph: DiGraph) -> List[Set[Atom]]:
     """
     Returns the Initial Strong Components of a given Graph
     :param graph:   A Graph.
     :return:        The Initial Strong Components of graph.
     """
-    iscc = []
-    sccs = nx.strongly_connected_components(graph)
-    for scc in sccs:
-        atoms = set(scc)
-        predecessors_set = set()
-        for atom in atoms:
-            predecessors_set = predecessors_set.union(set(graph.predecessors(atom)))
-        if predecessors_set.issubset(atoms):
-            iscc.append(atoms)
-    return iscc
+    return graph.initial_strong_components()
+
+
+def iter_reductible_sets(q: ConjunctiveQuery, a_graph: DiGraph) -> Iterator[List[Atom]]:
+    """
+    Yields, one at a time, the cycles in the M-graph of q that corresponds to an initial strong component in the attack
+    graph of q. The M-graph is only computed on the atoms of the initial strong components.
+    :param q:           A ConjunctiveQuery
+    :param a_graph:     The attack graph of q
+    :return:            A generator of cycles
+    """
+    for component in initial_strong_components(a_graph):
+        yield from gen_m_graph(q, component).simple_cycles()
+
+
+@phase("get_reductible_sets")
+def get_reductible_set(q: ConjunctiveQuery, a_graph: DiGraph) -> List[Atom]:
+    """
+    Returns a cycle in the M-graph of q that corresponds to an initial strong component in the attack graph of q.
+    The cycle is found with a depth first search on the M-graph of each initial strong component.
+    :param q:           A ConjunctiveQuery
+    :param a_graph:     The attack graph of q
+    :return:            A cycle (None if there is no such cycle)
+    """
+    for component in initial_strong_components(a_graph):
+        cycle = gen_m_graph(q, component).find_cycle()
+        if cycle is not None:
+            return cycle
+    return None
 
 
-def get_reductible_sets(q: ConjunctiveQuery, a_graph: nx.DiGraph) -> List[List[Atom]]:
+@phase("get_reductible_sets")
+def get_reductible_sets(q: ConjunctiveQuery, a_graph: DiGraph) -> List[List[Atom]]:
     """
     Returns the cycles in the M-graph of q that corresponds to an initial strong component in the attack graph of q
     :param q:           A ConjunctiveQuery
     :param a_graph:     The attack graph of q
     :return:            A list containing all the cycles
     """
-    isc = initial_strong_components(a_graph)
-    m_graph = gen_m_graph(q)
-    m_cycles = [cycle for cycle in nx.simple_cycles(m_graph)]
-    good_cycles = []
-    for cycle in m_cycles:
-        for component in isc:
-            if set(cycle).issubset(component):
-                good_cycles.append(cycle)
-    return good_cycles
+    return list(iter_reductible_sets(q, a_graph))
@@ -0,0 +1,281 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+from cqapk_to_datalog.data_structures import DatalogProgram, DatalogQuery, Atom
+import cqapk_to_datalog
+
+
+class RewritingCache:
+    """
+    In-memory LRU cache of rewritings. Rewritings are stored under the key of the canonical form of the rewritten query
+    (See canonical.CanonicalQuery) so that queries that are equal up to a renaming share the same entry.
+    A RewritingCache is not shared by processes : each worker process of rewrite_many uses its own copy of the cache
+    (Starting with its entries) and the hits and misses of the workers are not counted by the original cache.
+    """
+
+    def __init__(self, maxsize: int = 128) -> None:
+        """
+        Constructor
+        :param maxsize:     Maximal number of rewritings kept in the cache
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> DatalogProgram:
+        """
+        Returns the rewriting stored under a given key and marks it as the most recently used
+        :param key:     Key of a canonical query
+        :return:        The cached DatalogProgram or None if the key is not in the cache
+        """
+        program = self.entries.get(key)
+        if program is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return program
+
+    def put(self, key: str, program: DatalogProgram) -> None:
+        """
+        Stores a rewriting under a given key, evicting the least recently used rewritings if the cache is full
+        :param key:         Key of a canonical query
+        :param program:     The rewriting of the canonical query
+        """
+        self.entries[key] = program
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Removes all the rewritings from the cache
+        """
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of cached rewritings
+        :return:    The number of cached rewritings
+        """
+        return len(self.entries)
+
+
+class DiskCache:
+    """
+    Persistent cache of rewritings stored in a SQLite file. Rewritings are stored under the key of the canonical form of
+    the rewritten query and the version of the package (Entries written by another version are ignored and removed).
+    The least recently used rewritings are evicted when the total size of the stored rewritings exceeds a given size.
+    The SQLite connection is opened by the constructor and then lazily by each other process using the cache (A connection must not be shared by
+    processes, eg. the worker processes of rewrite_many) and a pickled DiskCache is reopened from its path.
+    New rewritings and uses of stored rewritings are written COMMIT_INTERVAL at a time (and when the cache is flushed or
+    closed, or when the process exits).
+    """
+    COMMIT_INTERVAL = 64
+
+    def __init__(self, path: str, max_size: int = 64 * 1024 * 1024) -> None:
+        """
+        Constructor
+        :param path:        Path of the SQLite file (Created if it does not exist)
+        :param max_size:    Maximal total size (in bytes) of the stored rewritings
+        """
+        self.path = path
+        self.max_size = max_size
+        self.version = cqapk_to_datalog.__version__
+        self.hits = 0
+        self.misses = 0
+        # Connections by process id (The connections inherited from a parent process are kept but never used)
+        self.connections = {}
+        self.finalizers = {}
+        # Changes not written yet : compressed rewritings by key and time of the last use by key
+        self.pending_data = {}
+        self.pending_uses = {}
+        # The file is initialized (in WAL mode, which cannot be set while other processes use the file) before it can
+        # be shared with other processes
+        self.connection
+
+    def __reduce__(self):
+        """
+        Pickling support (eg. to send the cache to a worker process) : the unpickled cache opens the same file
+        :return: Reconstruction data
+        """
+        return DiskCache, (self.path, self.max_size)
+
+    @property
+    def connection(self) -> 'sqlite3.Connection':
+        """
+        SQLite connection of the current process (Opened at the first use in each process)
+        """
+        import os
+        connection = self.connections.get(os.getpid())
+        if connection is None:
+            import sqlite3
+            from multiprocessing.util import Finalize
+            # The file may be shared by the worker processes of rewrite_many
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            if connection.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                connection.execute("PRAGMA journal_mode=WAL")
+            with self.transaction(connection):
+                connection.execute("CREATE TABLE IF NOT EXISTS rewritings (key TEXT, version TEXT, data BLOB, "
+                                   "size INTEGER, last_used REAL, PRIMARY KEY (key, version))")
+                connection.execute("CREATE INDEX IF NOT EXISTS rewritings_last_used ON rewritings (last_used)")
+                connection.execute("CREATE TABLE IF NOT EXISTS cache_size (total INTEGER)")
+                connection.execute("DELETE FROM rewritings WHERE version != ?", (self.version,))
+                # The total size is computed once, and then updated by each change
+                connection.execute("DELETE FROM cache_size")
+                connection.execute("INSERT INTO cache_size SELECT COALESCE(SUM(size), 0) FROM rewritings")
+            self.connections[os.getpid()] = connection
+            # Pending changes are written when the process exits (including the worker processes of rewrite_many)
+            self.finalizers[os.getpid()] = Finalize(self, self.flush, exitpriority=0)
+        return connection
+
+    @staticmethod
+    @contextmanager
+    def transaction(connection: 'sqlite3.Connection') -> Iterator[None]:
+        """
+        Runs the with block in a transaction that takes the write lock of the file when it starts (so that waiting for
+        another process is handled by the timeout of the connection)
+        :param connection:  A SQLite connection (in autocommit mode)
+        """
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def get(self, key: str) -> DatalogProgram:
+        """
+        Returns the rewriting stored under a given key and marks it as the most recently used
+        :param key:     Key of a canonical query
+        :return:        The cached DatalogProgram or None if the key is not in the cache
+        """
+        import pickle
+        import zlib
+        data = self.pending_data.get(key)
+        if data is None:
+            row = self.connection.execute("SELECT data FROM rewritings WHERE key = ? AND version = ?",
+                                          (key, self.version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            data = row[0]
+            self.pending_uses[key] = time.time()
+            self.changed()
+        self.hits += 1
+        return pickle.loads(zlib.decompress(data))
+
+    def put(self, key: str, program: DatalogProgram) -> None:
+        """
+        Stores a rewriting under a given key, evicting the least recently used rewritings if the cache is too big
+        :param key:         Key of a canonical query
+        :param program:     The rewriting of the canonical query
+        """
+        import pickle
+        import zlib
+        self.pending_data[key] = zlib.compress(pickle.dumps(plain_program(program), pickle.HIGHEST_PROTOCOL))
+        self.changed()
+
+    def changed(self) -> None:
+        """
+        Writes the pending changes if there are COMMIT_INTERVAL of them
+        """
+        if len(self.pending_data) + len(self.pending_uses) >= self.COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the pending changes in a single transaction, evicting the least recently used rewritings if the cache
+        is too big (The rewritings that have just been stored are kept, even if they are bigger than max_size)
+        """
+        if not self.pending_data and not self.pending_uses:
+            return
+        now = time.time()
+        connection = self.connection
+        with self.transaction(connection):
+            connection.executemany("UPDATE rewritings SET last_used = ? WHERE key = ? AND version = ?",
+                                   [(last_used, key, self.version) for key, last_used in self.pending_uses.items()])
+            added = 0
+            for key, data in self.pending_data.items():
+                row = connection.execute("SELECT size FROM rewritings WHERE key = ? AND version = ?",
+                                         (key, self.version)).fetchone()
+                connection.execute("INSERT OR REPLACE INTO rewritings VALUES (?, ?, ?, ?, ?)",
+                                   (key, self.version, data, len(data), now))
+                added += len(data) - (row[0] if row else 0)
+            connection.execute("UPDATE cache_size SET total = total + ?", (added,))
+            total = connection.execute("SELECT total FROM cache_size").fetchone()[0]
+            while total > self.max_size:
+                rows = connection.execute("SELECT key, size FROM rewritings WHERE last_used < ? ORDER BY last_used "
+                                          "LIMIT ?", (now, self.COMMIT_INTERVAL)).fetchall()
+                if not rows:
+                    break
+                removed = 0
+                for old_key, size in rows:
+                    if total - removed <= self.max_size:
+                        break
+                    connection.execute("DELETE FROM rewritings WHERE key = ? AND version = ?", (old_key, self.version))
+                    removed += size
+                connection.execute("UPDATE cache_size SET total = total - ?", (removed,))
+                total -= removed
+        self.pending_data.clear()
+        self.pending_uses.clear()
+
+    def clear(self) -> None:
+        """
+        Removes all the rewritings from the cache
+        """
+        self.pending_data.clear()
+        self.pending_uses.clear()
+        connection = self.connection
+        with self.transaction(connection):
+            connection.execute("DELETE FROM rewritings")
+            connection.execute("UPDATE cache_size SET total = 0")
+
+    def close(self) -> None:
+        """
+        Writes the pending changes and closes the SQLite file (if it has been opened by the current process)
+        """
+        import os
+        self.flush()
+        connection = self.connections.pop(os.getpid(), None)
+        if connection is not None:
+            self.finalizers.pop(os.getpid()).cancel()
+            connection.close()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of cached rewritings
+        :return:    The number of cached rewritings
+        """
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM rewritings").fetchone()[0]
+
+
+def plain_program(program: DatalogProgram) -> DatalogProgram:
+    """
+    Copies a DatalogProgram using only DatalogQuery objects for its rules (The rules built by rules_templates keep
+    references to the data used to build them, which should not be serialized). Identical atoms of different rules
+    are replaced by a single object so that they are only stored (and rebuilt when loaded) once.
+    :param program:     A DatalogProgram
+    :return:            An equal DatalogProgram whose rules are DatalogQuery objects
+    """
+    atoms = {}
+
+    def shared(atom):
+        if not isinstance(atom, Atom):
+            return atom
+        # AtomValues are interned and a variable is equal to the constant of the same name, so values are compared
+        # by identity
+        key = (atom.name, tuple(map(id, atom.content)), frozenset(map(id, atom.released)))
+        return atoms.setdefault(key, atom)
+
+    rules = []
+    for rule in program.rules:
+        new_rule = DatalogQuery(shared(rule.head))
+        for atom in rule.atoms:
+            new_rule.add_atom(shared(atom), rule.neg[atom])
+        rules.append(new_rule)
+    return DatalogProgram(rules, program.complexity)
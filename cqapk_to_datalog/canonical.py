@@ -0,0 +1,241 @@
+import re
+import hashlib
+from itertools import permutations, product
+from math import factorial
+from typing import List, Dict, Tuple
+from cqapk_to_datalog.data_structures import AtomValue, Atom, EqualityAtom, CompareAtom, DatalogQuery, DatalogProgram, \
+    ConjunctiveQuery, FunctionalDependency, FunctionalDependencySet
+
+# Maximal number of orderings of the atoms that cannot be distinguished by refinement that are tried
+MAX_ORDERINGS = 120
+# Names given to the relations and variables of a canonical query, and names derived from them in a rewriting
+# (eg. Eq_R0, N_R0, V0_1)
+RELATION_NAME = re.compile(r"^(.*_)?(R\d+)$")
+VALUE_NAME = re.compile(r"^(V\d+)((?:_\d+)*)$")
+
+
+class CanonicalQuery:
+    """
+    Canonical form of a ConjunctiveQuery : the query obtained by renaming its relations R0, R1, ... and its variables
+    V0, V1, ... in an order that does not depend on the original names, together with the renamings needed to go back
+    to the original names. Two queries that are equal up to a renaming of their relations and variables usually get
+    the same canonical form (always, if the atoms can be distinguished by their structure).
+    """
+
+    def __init__(self, query: ConjunctiveQuery, encoding: str, relation_names: Dict[str, str],
+                 value_names: Dict[str, str], restorable: bool) -> None:
+        """
+        Constructor
+        :param query:           The canonical ConjunctiveQuery
+        :param encoding:        String encoding the canonical query
+        :param relation_names:  Maps the canonical name of each relation to its original name
+        :param value_names:     Maps the canonical name of each variable to its original name
+        :param restorable:      False if a constant of the query could be confused with a canonical variable name (The
+                                rewriting of the canonical query can then not be renamed back)
+        """
+        self.query = query
+        self.encoding = encoding
+        self.key = hashlib.sha256(encoding.encode("utf-8")).hexdigest()
+        self.relation_names = relation_names
+        self.value_names = value_names
+        self.restorable = restorable
+        # AtomValues are interned (and equal when their names are equal) so they are memoized by identity
+        self.restored_values = {}
+
+    def restore_value(self, value: AtomValue) -> AtomValue:
+        """
+        Renames back a Variable/Constant of the rewriting of the canonical query
+        :param value:   A Variable or Constant
+        :return:        The Variable or Constant using the original names
+        """
+        res = self.restored_values.get(id(value))
+        if res is None:
+            res = value
+            match = VALUE_NAME.match(value.name)
+            if match and match.group(1) in self.value_names:
+                res = AtomValue(self.value_names[match.group(1)] + match.group(2), value.var)
+            self.restored_values[id(value)] = res
+        return res
+
+    def restore_atom(self, atom: Atom) -> Atom:
+        """
+        Renames back an Atom of the rewriting of the canonical query
+        :param atom:    An Atom
+        :return:        The Atom using the original names
+        """
+        name = atom.name
+        match = RELATION_NAME.match(name)
+        if match and match.group(2) in self.relation_names:
+            name = (match.group(1) or "") + self.relation_names[match.group(2)]
+        return Atom(name, [self.restore_value(value) for value in atom.content],
+                    [self.restore_value(value) for value in atom.released])
+
+    def restore(self, program: DatalogProgram) -> DatalogProgram:
+        """
+        Renames back the rewriting of the canonical query so that it becomes a rewriting of the original query
+        :param program:     A DatalogProgram (The rewriting of the canonical query)
+        :return:            The renamed DatalogProgram
+        """
+        restored_atoms = {}
+
+        def restore_any(atom):
+            # Atoms shared by several rules (eg. loaded from a DiskCache) are only renamed once
+            new_atom = restored_atoms.get(id(atom))
+            if new_atom is None:
+                if isinstance(atom, EqualityAtom):
+                    new_atom = EqualityAtom(self.restore_value(atom.v1), self.restore_value(atom.v2), atom.negative)
+                elif isinstance(atom, CompareAtom):
+                    new_atom = CompareAtom(self.restore_value(atom.v1), self.restore_value(atom.v2), atom.bigger)
+                else:
+                    new_atom = self.restore_atom(atom)
+                restored_atoms[id(atom)] = new_atom
+            return new_atom
+
+        rules = []
+        for rule in program.rules:
+            new_rule = DatalogQuery(restore_any(rule.head))
+            for atom in rule.atoms:
+                new_rule.add_atom(restore_any(atom), rule.neg[atom])
+            rules.append(new_rule)
+        return DatalogProgram(rules, program.complexity)
+
+
+def rank(signatures: List[object]) -> List[int]:
+    """
+    Replaces each signature by its rank among the distinct signatures
+    :param signatures:  A list of comparable signatures
+    :return:            The list of ranks
+    """
+    ranks = {signature: i for i, signature in enumerate(sorted(set(signatures)))}
+    return [ranks[signature] for signature in signatures]
+
+
+def atom_colors(q: ConjunctiveQuery, atoms: List[Atom], variable_names: Dict[str, int]) -> List[int]:
+    """
+    Colors the atoms of a query by refining their structure (arity, key positions, consistency, constants, repeated
+    values, free variables and FDs) with the structure of the atoms sharing variables with them, until the number of
+    colors is stable. Colors do not depend on the names of the relations and variables.
+    :param q:               A ConjunctiveQuery
+    :param atoms:           The atoms of q
+    :param variable_names:  Maps the name of each variable of q to its position in q.free_vars (-1 if not free)
+    :return:                The color of each atom
+    """
+    signatures = []
+    for atom in atoms:
+        local = {}
+        pattern = []
+        for value in atom.content:
+            if value.name in variable_names:
+                pattern.append(("v", local.setdefault(value.name, len(local)), int(value.var),
+                                variable_names[value.name], ""))
+            else:
+                pattern.append(("c", 0, 0, -1, value.name))
+        fds = sorted((tuple(sorted(local.get(var.name, -1) for var in fd.left)), local.get(fd.right.name, -1))
+                     for fd in q.content[atom].fd_set.set)
+        signatures.append((len(atom.content), tuple(q.content[atom].is_key), q.content[atom].consistent,
+                           tuple(pattern), tuple(fds)))
+    colors = rank(signatures)
+    n_colors = len(set(colors))
+    for _ in range(len(atoms)):
+        occurrences = {}
+        for color, atom in zip(colors, atoms):
+            for position, value in enumerate(atom.content):
+                if value.name in variable_names:
+                    occurrences.setdefault(value.name, []).append((color, position))
+        names = list(occurrences)
+        value_colors = dict(zip(names, rank([tuple(sorted(occurrences[name])) for name in names])))
+        colors = rank([(color, tuple(value_colors.get(value.name, -1) for value in atom.content))
+                       for color, atom in zip(colors, atoms)])
+        if len(set(colors)) == n_colors:
+            break
+        n_colors = len(set(colors))
+    return colors
+
+
+def encode(q: ConjunctiveQuery, atoms: List[Atom], variable_names: Dict[str, int]) \
+        -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    """
+    Encodes a query whose atoms are taken in a given order. Relations and variables are named in order of appearance.
+    :param q:               A ConjunctiveQuery
+    :param atoms:           The atoms of q in the chosen order
+    :param variable_names:  Maps the name of each variable of q to its position in q.free_vars (-1 if not free)
+    :return:                The encoding, and the maps from the original names of relations and variables to their
+                            canonical names
+    """
+    relations = {}
+    values = {}
+    for atom in atoms:
+        relations.setdefault(atom.name, "R" + str(len(relations)))
+        for value in atom.content:
+            if value.name in variable_names:
+                values.setdefault(value.name, "V" + str(len(values)))
+    for name in sorted(variable_names, key=lambda n: (variable_names[n] < 0, variable_names[n], n)):
+        values.setdefault(name, "V" + str(len(values)))
+
+    def value_code(value):
+        if value.name in values:
+            return ("?" if value.var else "!") + values[value.name]
+        return repr(value.name)
+
+    parts = []
+    for atom in atoms:
+        q_atom = q.content[atom]
+        fds = sorted("{" + ",".join(sorted(values[var.name] for var in fd.left)) + "}->" + values[fd.right.name]
+                     for fd in q_atom.fd_set.set)
+        parts.append(relations[atom.name] + "(" + ",".join(value_code(value) for value in atom.content) + ")" +
+                     "".join("1" if k else "0" for k in q_atom.is_key) + ("*" if q_atom.consistent else "") +
+                     "[" + ",".join(sorted(values[var.name] for var in atom.released)) + "]" + ";".join(fds))
+    free = ",".join(values[var.name] for var in q.free_vars)
+    return "[" + free + "]:" + " ".join(parts), relations, values
+
+
+def canonicalize(q: ConjunctiveQuery) -> CanonicalQuery:
+    """
+    Computes the canonical form of a ConjunctiveQuery
+    :param q:   A ConjunctiveQuery
+    :return:    The CanonicalQuery of q
+    """
+    atoms = list(q.content)
+    variable_names = {}
+    for var in q.free_vars:
+        variable_names.setdefault(var.name, len(variable_names))
+    for atom in atoms:
+        for value in list(atom.variables()) + list(atom.released):
+            variable_names.setdefault(value.name, -1)
+        for fd in q.content[atom].fd_set.set:
+            for var in list(fd.left) + [fd.right]:
+                variable_names.setdefault(var.name, -1)
+    colors = atom_colors(q, atoms, variable_names)
+    groups = {}
+    for color, atom in sorted(zip(colors, atoms), key=lambda pair: (pair[0], pair[1].name)):
+        groups.setdefault(color, []).append(atom)
+    groups = [groups[color] for color in sorted(groups)]
+    n_orderings = 1
+    for group in groups:
+        n_orderings *= factorial(len(group))
+    if n_orderings <= MAX_ORDERINGS:
+        orderings = product(*[permutations(group) for group in groups])
+    else:
+        orderings = [groups]
+    encoding, relations, values = min((encode(q, [atom for group in ordering for atom in group], variable_names)
+                                       for ordering in orderings), key=lambda encoded: encoded[0])
+
+    def rename(value):
+        if value.name in values:
+            return AtomValue(values[value.name], value.var)
+        return value
+
+    content = {}
+    for atom in atoms:
+        q_atom = q.content[atom]
+        new_atom = Atom(relations[atom.name], [rename(value) for value in atom.content],
+                        [rename(value) for value in atom.released])
+        fd_set = FunctionalDependencySet([FunctionalDependency([rename(var) for var in fd.left], rename(fd.right))
+                                          for fd in q_atom.fd_set.set])
+        content[new_atom] = (fd_set, list(q_atom.is_key), q_atom.consistent)
+    content = dict(sorted(content.items(), key=lambda item: int(item[0].name[1:])))
+    query = ConjunctiveQuery(content, [rename(var) for var in q.free_vars])
+    restorable = not any(VALUE_NAME.match(value.name) for atom in atoms for value in atom.content
+                         if value.name not in values)
+    return CanonicalQuery(query, encoding, {v: k for k, v in relations.items()}, {v: k for k, v in values.items()},
+                          restorable)
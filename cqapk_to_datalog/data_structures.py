@@ -1,20 +1,42 @@
-from typing import Set, FrozenSet, List, Dict, Tuple, Union
+from typing import Set, FrozenSet, List, Dict, Tuple, Union, Iterable
 from copy import copy
+from weakref import WeakValueDictionary
+from cqapk_to_datalog.instrumentation import counted
 
 
 class AtomValue:
     """
-    Class representing a value belonging to an Atom ie a Variable or a Constant
+    Class representing a value belonging to an Atom ie a Variable or a Constant.
+    Instances are interned : constructing an AtomValue returns the canonical instance for its (name, variable) pair,
+    so most comparisons are identity tests. The hash of the name is computed once.
+    The interning table only holds weak references : a value is dropped from it once it is no longer used, so long
+    running processes do not accumulate the names of all the queries they saw.
     """
+    __slots__ = ("name", "var", "_hash", "__weakref__")
 
-    def __init__(self, name: str, variable: bool):
+    def __new__(cls, name: str, variable: bool) -> 'AtomValue':
         """
-        Constructor
+        Constructor (interning factory)
         :param name: name of the value
         :param variable: True if the value is a variable, False if it is a constant
+        :return: The canonical AtomValue for (name, variable)
+        """
+        variable = bool(variable)
+        value = _interned_values.get((name, variable))
+        if value is None:
+            value = object.__new__(cls)
+            value.name = name
+            value.var = variable
+            value._hash = hash(name)
+            _interned_values[(name, variable)] = value
+        return value
+
+    def __reduce__(self):
         """
-        self.name = name
-        self.var = variable
+        Pickling support : unpickled values go through the interning factory
+        :return: Reconstruction data
+        """
+        return AtomValue, (self.name, self.var)
 
     def __str__(self) -> str:
         """
@@ -29,6 +51,8 @@ class AtomValue:
         :param other: Another object
         :return: True if the objects are equal, else returns False
         """
+        if self is other:
+            return True
         if not isinstance(other, AtomValue):
             return NotImplemented
         return self.name == other.name
@@ -45,7 +69,10 @@ class AtomValue:
         Hash method
         :return: Hash value
         """
-        return hash(self.name)
+        return self._hash
+
+
+_interned_values: 'WeakValueDictionary[Tuple[str, bool], AtomValue]' = WeakValueDictionary()
 
 
 class FunctionalDependency:
@@ -97,31 +124,67 @@ class FunctionalDependency:
 class FunctionalDependencySet:
     """
     Class representing a set of non-trivial FunctionalDependencies.
+    FunctionalDependencies added one by one are accumulated in a mutable set which is frozen once, the next time the
+    set is read.
     """
 
-    def __init__(self, set_def: FrozenSet[FunctionalDependency] = None):
+    def __init__(self, set_def: Iterable[FunctionalDependency] = None):
         """
         Constructor
         :param set_def:     A set of FunctionalDependencies to be added at construction.
         """
         if set_def is None:
-            self.set = frozenset()
+            self._set = frozenset()
         else:
-            self.set = set_def
+            self._set = frozenset(set_def)
+        self._pending = None
+
+    @property
+    def set(self) -> FrozenSet[FunctionalDependency]:
+        """
+        Returns the FunctionalDependencies in this set
+        :return:            A FrozenSet of FunctionalDependencies
+        """
+        if self._pending is not None:
+            self._set = frozenset(self._pending)
+            self._pending = None
+        return self._set
+
+    @set.setter
+    def set(self, set_def: FrozenSet[FunctionalDependency]) -> None:
+        """
+        Replaces the FunctionalDependencies in this set
+        :param set_def:     A FrozenSet of FunctionalDependencies
+        """
+        self._set = set_def
+        self._pending = None
+
+    @staticmethod
+    def union_all(fd_sets: Iterable['FunctionalDependencySet']) -> 'FunctionalDependencySet':
+        """
+        Returns the union of several FunctionalDependencySets, computed in one pass.
+        :param fd_sets:     FunctionalDependencySets
+        :return:            A new FunctionalDependencySet
+        """
+        return FunctionalDependencySet(frozenset().union(*[fd_set.set for fd_set in fd_sets]))
 
     def add(self, fd: FunctionalDependency) -> None:
         """
-        Adds a new FunctionalDependency.
+        Adds a new FunctionalDependency (Amortized constant time).
         :param fd:          A FunctionalDependency
         """
-        self.set = self.set.union({fd})
+        if self._pending is None:
+            self._pending = set(self._set)
+        self._pending.add(fd)
 
     def remove(self, fd: FunctionalDependency) -> None:
         """
         Removes a FunctionalDependency.
         :param fd:          A FunctionalDependency
         """
-        self.set = self.set - {fd}
+        if self._pending is None:
+            self._pending = set(self._set)
+        self._pending.discard(fd)
 
     def release_variable(self, var: AtomValue) -> 'FunctionalDependencySet':
         """
@@ -129,12 +192,41 @@ class FunctionalDependencySet:
         :param var:         Variable that has been released
         :return:            New FunctionalDependencySet
         """
-        new_set = frozenset()
-        for fd in self.set:
-            left = fd.left - {var}
-            if fd.right != var:
-                new_set = new_set.union({FunctionalDependency(list(left), fd.right)})
-        return FunctionalDependencySet(new_set)
+        return self.release_variables([var])
+
+    def release_variables(self, variables: Iterable[AtomValue]) -> 'FunctionalDependencySet':
+        """
+        Function called when a set of variables is released. Computes a new FunctionalDependencySet in one pass.
+        :param variables:   Variables that have been released
+        :return:            New FunctionalDependencySet
+        """
+        released = frozenset(variables)
+        return FunctionalDependencySet(frozenset([FunctionalDependency(list(fd.left - released), fd.right)
+                                                  for fd in self.set if fd.right not in released]))
+
+    def variables(self) -> FrozenSet[AtomValue]:
+        """
+        Returns the variables appearing in the FunctionalDependencies. The result is cached until the set changes.
+        :return:            A FrozenSet of variables
+        """
+        if getattr(self, "_variables_from", None) is not self.set:
+            variables = set()
+            for fd in self.set:
+                variables.update(fd.left)
+                variables.add(fd.right)
+            self._variables = frozenset(variables)
+            self._variables_from = self.set
+        return self._variables
+
+    def compile(self) -> 'CompiledFunctionalDependencySet':
+        """
+        Returns the compiled form of this FunctionalDependencySet. The compiled form is cached until the set changes.
+        :return:            A CompiledFunctionalDependencySet
+        """
+        if getattr(self, "_compiled_from", None) is not self.set:
+            self._compiled = CompiledFunctionalDependencySet(self.set)
+            self._compiled_from = self.set
+        return self._compiled
 
     def union(self, other: 'FunctionalDependencySet') -> 'FunctionalDependencySet':
         """
@@ -164,45 +256,243 @@ class FunctionalDependencySet:
         return str(self.set)
 
 
+class CompiledFunctionalDependencySet:
+    """
+    Compiled representation of a set of FunctionalDependencies used to compute closures.
+    Variables are mapped to bit positions, left sides are stored as int masks and closures are computed with the
+    counter-based linear algorithm of Beeri and Bernstein.
+    Each FunctionalDependency may be tagged with an owner (eg. the atom it comes from) so that closures can be
+    computed without the FunctionalDependencies of a given owner.
+    """
+
+    def __init__(self, fds: Iterable[FunctionalDependency], owners: Iterable[object] = None) -> None:
+        """
+        Constructor
+        :param fds:         The FunctionalDependencies to be compiled
+        :param owners:      The owner of each FunctionalDependency (In the same order as fds)
+        """
+        self.bits = {}
+        self.values = []
+        self.watchers = []
+        self.lefts = []
+        self.left_sizes = []
+        self.rights = []
+        self.owners = []
+        self.owner_ids = {}
+        self.unconditional = []
+        owners = iter(owners) if owners is not None else None
+        for fd in fds:
+            index = len(self.lefts)
+            left = self.mask(fd.left)
+            self.lefts.append(left)
+            self.left_sizes.append(len(fd.left))
+            self.rights.append(self.bit(fd.right))
+            self.owners.append(-1 if owners is None else self.owner_ids.setdefault(next(owners), len(self.owner_ids)))
+            if left == 0:
+                self.unconditional.append(index)
+            for b in self.mask_bits(left):
+                self.watchers[b].append(index)
+
+    def bit(self, var: AtomValue) -> int:
+        """
+        Returns the bit position of a variable (A new position is assigned to unknown variables)
+        :param var:         A variable
+        :return:            Its bit position
+        """
+        b = self.bits.get(var)
+        if b is None:
+            b = len(self.values)
+            self.bits[var] = b
+            self.values.append(var)
+            self.watchers.append([])
+        return b
+
+    def mask(self, variables: Iterable[AtomValue]) -> int:
+        """
+        Returns the mask representing a set of variables
+        :param variables:   Variables
+        :return:            An int mask
+        """
+        m = 0
+        for var in variables:
+            m |= 1 << self.bit(var)
+        return m
+
+    @staticmethod
+    def mask_bits(mask: int) -> List[int]:
+        """
+        Returns the positions of the bits set in a mask
+        :param mask:        An int mask
+        :return:            A list of bit positions
+        """
+        res = []
+        while mask:
+            low = mask & -mask
+            res.append(low.bit_length() - 1)
+            mask ^= low
+        return res
+
+    def variables(self, mask: int) -> Set[AtomValue]:
+        """
+        Returns the set of variables represented by a mask
+        :param mask:        An int mask
+        :return:            A set of variables
+        """
+        return {self.values[b] for b in self.mask_bits(mask)}
+
+    @counted("closure_mask")
+    def closure_mask(self, mask: int, exclude: object = None) -> int:
+        """
+        Computes the closure of a set of variables represented as a mask
+        :param mask:        An int mask
+        :param exclude:     Owner whose FunctionalDependencies must not be used
+        :return:            The mask of the closure
+        """
+        excluded = -2 if exclude is None else self.owner_ids.get(exclude, -2)
+        counts = self.left_sizes.copy()
+        rights = self.rights
+        owners = self.owners
+        watchers = self.watchers
+        closure = mask
+        stack = self.mask_bits(mask)
+        for index in self.unconditional:
+            r = rights[index]
+            if not closure >> r & 1 and owners[index] != excluded:
+                closure |= 1 << r
+                stack.append(r)
+        while stack:
+            for index in watchers[stack.pop()]:
+                counts[index] -= 1
+                if counts[index] == 0:
+                    r = rights[index]
+                    if not closure >> r & 1 and owners[index] != excluded:
+                        closure |= 1 << r
+                        stack.append(r)
+        return closure
+
+    @counted("closure_masks")
+    def closure_masks(self, masks: List[int]) -> List[int]:
+        """
+        Computes the closures of several sets of variables at once. The computation is bit-parallel over the sets : for
+        each variable, an int mask tells which of the sets currently imply it, and a FunctionalDependency propagates the
+        AND of the masks of its left side to its right side until a fixpoint is reached.
+        As in closure, the closure of an empty set is left empty.
+        :param masks:       The int masks of the sets of variables
+        :return:            The masks of the closures (In the same order as masks)
+        """
+        n_bits = len(self.values)
+        holders = [0] * n_bits
+        everyone = 0
+        for i, mask in enumerate(masks):
+            if mask:
+                everyone |= 1 << i
+                for b in self.mask_bits(mask):
+                    holders[b] |= 1 << i
+        to_visit = list(range(len(self.lefts)))
+        queued = [True] * len(self.lefts)
+        while to_visit:
+            index = to_visit.pop()
+            queued[index] = False
+            implied = everyone
+            for b in self.mask_bits(self.lefts[index]):
+                implied &= holders[b]
+            r = self.rights[index]
+            if implied & ~holders[r]:
+                holders[r] |= implied
+                for watcher in self.watchers[r]:
+                    if not queued[watcher]:
+                        queued[watcher] = True
+                        to_visit.append(watcher)
+        res = [0] * len(masks)
+        for b in range(n_bits):
+            for i in self.mask_bits(holders[b]):
+                res[i] |= 1 << b
+        return res
+
+    def closure(self, variables: Iterable[AtomValue], exclude: object = None) -> Set[AtomValue]:
+        """
+        Computes the transitive closure of a set of variables
+        :param variables:   A set of variables
+        :param exclude:     Owner whose FunctionalDependencies must not be used
+        :return:            The transitive closure of variables
+        """
+        res = set(variables)
+        if res:
+            # As in the original fixpoint computation, the closure of an empty set is left empty
+            res.update(self.variables(self.closure_mask(self.mask(res), exclude)))
+        return res
+
+
 class Atom:
     """
-    Class representing an atom
+    Class representing an atom.
+    Atoms are immutable (setting an attribute raises an AttributeError) : the partitions of the content, the hash and
+    the string representation are computed once.
     """
+    __slots__ = ("name", "content", "released", "_variables", "_all_variables", "_constants", "_hash", "_str")
 
-    def __init__(self, name: str, content: List[AtomValue], released: Set[AtomValue] = None) -> None:
+    def __init__(self, name: str, content: List[AtomValue], released: Iterable[AtomValue] = None) -> None:
         """
         Constructor
         :param name:            Name of the relation
         :param content:         List representing the content of the Atom. May contain Variables and Constants
-        :param released:        List of released variables
+        :param released:        Released variables
         """
-        self.name = name
-        self.content = tuple(content)
-        if released is None:
-            self.released = set()
-        else:
-            self.released = released
+        content = tuple(content)
+        released = frozenset() if released is None else frozenset(released)
+        all_variables = tuple(var for var in content if var.var)
+        set_attribute = object.__setattr__
+        set_attribute(self, "name", name)
+        set_attribute(self, "content", content)
+        set_attribute(self, "released", released)
+        set_attribute(self, "_all_variables", all_variables)
+        set_attribute(self, "_variables", tuple(var for var in all_variables if var not in released))
+        set_attribute(self, "_constants", tuple(con for con in content if not con.var or con in released))
+        set_attribute(self, "_hash", hash((name, content)))
+        set_attribute(self, "_str", None)
 
-    def variables(self) -> List[AtomValue]:
+    def __setattr__(self, name: str, value: object) -> None:
+        """
+        Atoms are immutable
+        :param name:    Name of the attribute
+        :param value:   New value
+        """
+        raise AttributeError("Atom objects are immutable")
+
+    def __delattr__(self, name: str) -> None:
+        """
+        Atoms are immutable
+        :param name:    Name of the attribute
+        """
+        raise AttributeError("Atom objects are immutable")
+
+    def __reduce__(self):
+        """
+        Pickling support : cached data is recomputed when unpickled
+        :return: Reconstruction data
+        """
+        return Atom, (self.name, self.content, self.released)
+
+    def variables(self) -> Tuple[AtomValue, ...]:
         """
         Returns the variables in the atom
-        :return: A list containing the variables in the atom (In order)
+        :return: A tuple containing the variables in the atom (In order)
         """
-        return [var for var in self.content if var.var and var not in self.released]
+        return self._variables
 
-    def all_variables(self) -> List[AtomValue]:
+    def all_variables(self) -> Tuple[AtomValue, ...]:
         """
         Returns the variables (including released variables) in the atom
-        :return: A list containing the variables in the atom (In order)
+        :return: A tuple containing the variables in the atom (In order)
         """
-        return [var for var in self.content if var.var]
+        return self._all_variables
 
-    def constants(self) -> List[AtomValue]:
+    def constants(self) -> Tuple[AtomValue, ...]:
         """
         Returns the constants in the atom
-        :return: A list containing the constants in the atom (In order)
+        :return: A tuple containing the constants in the atom (In order)
         """
-        return [con for con in self.content if not con.var or con in self.released]
+        return self._constants
 
     def release_variable(self, var: AtomValue) -> 'Atom':
         """
@@ -210,12 +500,20 @@ class Atom:
         :param var:         The variable to be released
         :return:            A new atom identical to this one, but where var is a released variable.
         """
-        if var in [v for v in self.content if v.var] and var not in self.released:
-            new_var = AtomValue(var.name, False)
-            new_content = [v if v != var else new_var for v in self.content]
-            return Atom(self.name, new_content, self.released.union({var}))
-        else:
+        return self.release_variables([var])
+
+    def release_variables(self, variables: Iterable[AtomValue]) -> 'Atom':
+        """
+        Releases a set of variables
+        :param variables:   The variables to be released
+        :return:            A new atom identical to this one, but where the given variables are released variables.
+        """
+        atom_variables = set(v for v in self.content if v.var)
+        to_release = set(var for var in variables if var in atom_variables and var not in self.released)
+        if len(to_release) == 0:
             return self
+        new_content = [AtomValue(v.name, False) if v in to_release else v for v in self.content]
+        return Atom(self.name, new_content, self.released.union(to_release))
 
     def __eq__(self, other: object):
         """
@@ -223,21 +521,24 @@ class Atom:
         :param other: Another object
         :return: True if the objects are equal, else returns False
         """
+        if self is other:
+            return True
         if not isinstance(other, Atom):
             return NotImplemented
         return self.name == other.name and self.content == other.content
 
     def __str__(self) -> str:
         """
-        String representation
+        String representation (Computed once)
         :return: String representation
         """
-        if len(self.content) == 0:
-            return self.name
-        content = ""
-        for value in self.content:
-            content += str(value) + ","
-        return self.name + "(" + content[:-1] + ")"
+        if self._str is None:
+            if len(self.content) == 0:
+                res = self.name
+            else:
+                res = self.name + "(" + ",".join([str(value) for value in self.content]) + ")"
+            object.__setattr__(self, "_str", res)
+        return self._str
 
     def __repr__(self) -> str:
         """
@@ -251,7 +552,7 @@ class Atom:
         Hash method
         :return: Hash value
         """
-        return hash((self.name, self.content))
+        return self._hash
 
 
 class EqualityAtom:
@@ -420,28 +721,88 @@ class DatalogQuery:
         return self.head == other.head and self.atoms == other.atoms and self.neg == other.neg
 
 
+class QueryAtom:
+    """
+    Data kept by a ConjunctiveQuery about one of its atoms : its set of FD, its key positions and its consistency.
+    The key and non-key projections of the atom are computed once, when the atom enters the query.
+    """
+    __slots__ = ("fd_set", "is_key", "consistent", "key", "not_key", "key_vars", "not_key_vars",
+                 "key_vars_with_free", "not_key_vars_with_free")
+
+    def __init__(self, atom: Atom, fd_set: FunctionalDependencySet, is_key: List[bool], consistent: bool) -> None:
+        """
+        Constructor
+        :param atom:            The Atom
+        :param fd_set:          Set of FunctionalDependency appearing in atom.
+        :param is_key:          List of bool such that is_key[i] is True iff the position i of atom belongs to the key.
+        :param consistent:      True iff atom is consistent.
+        """
+        self.fd_set = fd_set
+        self.is_key = is_key
+        self.consistent = consistent
+        variables = set(atom.variables())
+        key = []
+        not_key = []
+        for i in range(len(atom.content)):
+            (key if is_key[i] else not_key).append(atom.content[i])
+        self.key = tuple(key)
+        self.not_key = tuple(not_key)
+        self.key_vars = tuple(value for value in key if value in variables)
+        self.not_key_vars = tuple(value for value in not_key if value in variables)
+        self.key_vars_with_free = tuple(value for value in key if value.var)
+        self.not_key_vars_with_free = tuple(value for value in not_key if value.var)
+
+    def release_variables(self, atom: Atom, variables: FrozenSet[AtomValue]) -> 'QueryAtom':
+        """
+        Returns the data of the atom once the given variables are released
+        :param atom:            The released Atom
+        :param variables:       The released variables
+        :return:                A new QueryAtom
+        """
+        return QueryAtom(atom, self.fd_set.release_variables(variables), self.is_key, self.consistent)
+
+    def __eq__(self, other: object) -> bool:
+        """
+        Comparator
+        :param other: Another object
+        :return: True if the objects are equal, else returns False
+        """
+        if not isinstance(other, QueryAtom):
+            return NotImplemented
+        return self.fd_set == other.fd_set and list(self.is_key) == list(other.is_key) and \
+            self.consistent == other.consistent
+
+
 class ConjunctiveQuery:
     """
     Class representing a Conjunctive Query.
-    We consider that a Conjunctive Query is a set of tuples (Atom, Set of FD, Key Positions, Consistent).
+    We consider that a Conjunctive Query is a set of tuples (Atom, Set of FD, Key Positions, Consistent), the last
+    three elements being kept in a QueryAtom.
     This object also contain a set of free variables.
     """
 
-    def __init__(self, content: Dict[Atom, Tuple[FunctionalDependencySet, List[bool], bool]] = None,
+    def __init__(self, content: Dict[Atom, Union[QueryAtom, Tuple[FunctionalDependencySet, List[bool], bool]]] = None,
                  free_vars: List[AtomValue] = None) -> None:
         """
         Constructor
-        :param content:     Content of the query
+        :param content:     Content of the query (Tuples (Set of FD, Key Positions, Consistent) are also accepted)
         :param free_vars:   Free variables
         """
         if content is None:
             self.content = {}
         else:
+            for atom, data in content.items():
+                if not isinstance(data, QueryAtom):
+                    content[atom] = QueryAtom(atom, *data)
             self.content = content
         if free_vars is None:
             self.free_vars = []
         else:
             self.free_vars = free_vars
+        self._fd_unions = {}
+        self._compiled_fd = {}
+        self._value_index = None
+        self._variable_index = None
 
     def get_atoms(self) -> Set[Atom]:
         """
@@ -470,12 +831,46 @@ class ConjunctiveQuery:
             res = res.union(set(atom.variables()))
         return res
 
+    def get_atoms_containing(self, value: AtomValue) -> Tuple[Atom, ...]:
+        """
+        Returns the atoms whose content contains a given value (Released variables included). The underlying
+        value -> atoms index is built once per query.
+        :param value:   An AtomValue
+        :return:        A tuple of Atom objects (In the order of the query).
+        """
+        if self._value_index is None:
+            self._value_index = self._build_index(lambda atom: atom.content)
+        return self._value_index.get(value, ())
+
+    def get_atoms_with_variable(self, var: AtomValue) -> Tuple[Atom, ...]:
+        """
+        Returns the atoms having a given (non released) variable. The underlying variable -> atoms index is built once
+        per query.
+        :param var:     A variable
+        :return:        A tuple of Atom objects (In the order of the query).
+        """
+        if self._variable_index is None:
+            self._variable_index = self._build_index(lambda atom: atom.variables())
+        return self._variable_index.get(var, ())
+
+    def _build_index(self, values) -> Dict[AtomValue, Tuple[Atom, ...]]:
+        """
+        Builds an incidence index mapping values to the atoms in which they appear.
+        :param values:  Function returning the values of an atom to be indexed
+        :return:        A Dict mapping each value to a tuple of atoms
+        """
+        index = {}
+        for atom in self.content:
+            for value in set(values(atom)):
+                index.setdefault(value, []).append(atom)
+        return {value: tuple(atoms) for value, atoms in index.items()}
+
     def get_consistent_atoms(self) -> Set[Atom]:
         """
         Returns only consistent atoms in the query.
         :return:    A set of Atom objects.
         """
-        return set([atom for atom in self.content if self.content[atom][2]])
+        return set([atom for atom in self.content if self.content[atom].consistent])
 
     def get_key(self, atom: Atom) -> List[AtomValue]:
         """
@@ -484,7 +879,7 @@ class ConjunctiveQuery:
         :return:        A List of AtomValue objects (Respecting Atom's order).
         """
         if atom in self.content:
-            return [atom.content[i] for i in range(len(atom.content)) if self.content[atom][1][i]]
+            return list(self.content[atom].key)
 
     def get_not_key(self, atom: Atom) -> List[AtomValue]:
         """
@@ -493,7 +888,7 @@ class ConjunctiveQuery:
         :return:        A List of AtomValue objects (Respecting Atom's order).
         """
         if atom in self.content:
-            return [atom.content[i] for i in range(len(atom.content)) if not self.content[atom][1][i]]
+            return list(self.content[atom].not_key)
 
     def get_key_vars(self, atom: Atom, with_free=False) -> List[AtomValue]:
         """
@@ -504,11 +899,9 @@ class ConjunctiveQuery:
         """
         if atom in self.content:
             if with_free:
-                return [atom.content[i] for i in range(len(atom.content)) if
-                        atom.content[i].var and self.content[atom][1][i]]
+                return list(self.content[atom].key_vars_with_free)
             else:
-                return [atom.content[i] for i in range(len(atom.content)) if
-                        atom.content[i] in atom.variables() and self.content[atom][1][i]]
+                return list(self.content[atom].key_vars)
 
     def get_not_key_vars(self, atom: Atom, with_free=False) -> List[AtomValue]:
         """
@@ -519,11 +912,9 @@ class ConjunctiveQuery:
         """
         if atom in self.content:
             if with_free:
-                return [atom.content[i] for i in range(len(atom.content)) if
-                        atom.content[i].var and not self.content[atom][1][i]]
+                return list(self.content[atom].not_key_vars_with_free)
             else:
-                return [atom.content[i] for i in range(len(atom.content)) if
-                        atom.content[i] in atom.variables() and not self.content[atom][1][i]]
+                return list(self.content[atom].not_key_vars)
 
     def get_all_fd(self, exclude: Atom = None) -> FunctionalDependencySet:
         """
@@ -531,11 +922,9 @@ class ConjunctiveQuery:
         :param exclude:     Atom to be excluded.
         :return:            A FunctionalDependencySet object.
         """
-        res = FunctionalDependencySet()
-        for atom in self.content:
-            if exclude is None or atom != exclude:
-                res = res.union(self.content[atom][0])
-        return res
+        if exclude is None:
+            return FunctionalDependencySet(self._get_fd_union(False))
+        return FunctionalDependencySet.union_all([data.fd_set for atom, data in self.content.items() if atom != exclude])
 
     def get_atom_fd(self, atom: Atom) -> FunctionalDependencySet:
         """
@@ -544,7 +933,7 @@ class ConjunctiveQuery:
         :return:        A FunctionalDependencySet object.
         """
         if atom in self.content:
-            return self.content[atom][0]
+            return self.content[atom].fd_set
 
     def is_atom_consistent(self, atom: Atom) -> bool:
         """
@@ -553,18 +942,56 @@ class ConjunctiveQuery:
         :return:        True if atom is consistent, False if not.
         """
         if atom in self.content:
-            return self.content[atom][2]
+            return self.content[atom].consistent
 
     def get_consistent_fd(self) -> FunctionalDependencySet:
         """
         Returns all the FunctionalDependencies of this query that appear in a consistent atom.
         :return:            A FunctionalDependencySet object.
         """
-        res = FunctionalDependencySet()
-        for atom in self.content:
-            if self.content[atom][2]:
-                res = res.union(self.content[atom][0])
-        return res
+        return FunctionalDependencySet(self._get_fd_union(True))
+
+    def _get_fd_union(self, consistent_only: bool) -> FrozenSet[FunctionalDependency]:
+        """
+        Returns the union of the FunctionalDependencies of all the atoms (Or only of the consistent ones). The union is
+        computed once per query.
+        :param consistent_only:     True if only the FunctionalDependencies of consistent atoms should be considered.
+        :return:                    A FrozenSet of FunctionalDependencies.
+        """
+        union = self._fd_unions.get(consistent_only)
+        if union is None:
+            union = FunctionalDependencySet.union_all([data.fd_set for data in self.content.values()
+                                                       if data.consistent or not consistent_only]).set
+            self._fd_unions[consistent_only] = union
+        return union
+
+    def get_compiled_fd(self, consistent_only: bool = False) -> CompiledFunctionalDependencySet:
+        """
+        Returns the compiled form of all the FunctionalDependencies of this query (Or only those appearing in a
+        consistent atom). It is built once and shared by all the closure computations made on this query.
+        Each FunctionalDependency is owned by its atom, so that closures can exclude the FunctionalDependencies of one
+        atom (eg. compiled.closure(variables, atom)) without building a new set.
+        :param consistent_only:     True if only the FunctionalDependencies of consistent atoms should be considered.
+        :return:                    A CompiledFunctionalDependencySet object.
+        """
+        compiled = self._compiled_fd.get(consistent_only)
+        if compiled is None:
+            fds = []
+            owners = []
+            for atom, data in self.content.items():
+                if data.consistent or not consistent_only:
+                    fds += data.fd_set.set
+                    owners += [atom] * len(data.fd_set.set)
+            compiled = CompiledFunctionalDependencySet(fds, owners)
+            self._compiled_fd[consistent_only] = compiled
+        return compiled
+
+    def builder(self) -> 'ConjunctiveQueryBuilder':
+        """
+        Returns a ConjunctiveQueryBuilder initialized with this query, used to apply several modifications at once.
+        :return:        A ConjunctiveQueryBuilder
+        """
+        return ConjunctiveQueryBuilder(self)
 
     def release_variable(self, var: AtomValue) -> 'ConjunctiveQuery':
         """
@@ -574,14 +1001,15 @@ class ConjunctiveQuery:
         """
         if var in self.free_vars or not var.var:
             return self
-        else:
-            new_content = {}
-            for atom in self.content:
-                new_atom = atom.release_variable(var)
-                fd_set = self.content[atom][0].release_variable(var)
-                new_content[new_atom] = (fd_set, self.content[atom][1], self.content[atom][2])
+        return self.builder().release_variable(var).build()
 
-        return ConjunctiveQuery(new_content, self.free_vars + [var])
+    def release_variables(self, variables: Iterable[AtomValue]) -> 'ConjunctiveQuery':
+        """
+        Releases a set of variables in one pass. A new ConjunctiveQuery is created where the given variables are free
+        variables (Added to the free variables in the given order).
+        :param variables:   AtomValue objects (Variables)
+        """
+        return self.builder().release_variables(variables).build()
 
     def remove_atom(self, atom: Atom) -> 'ConjunctiveQuery':
         """
@@ -591,11 +1019,7 @@ class ConjunctiveQuery:
         """
         if atom not in self.content:
             return self
-        new_content = {}
-        for key in self.content:
-            if key != atom:
-                new_content[key] = self.content[key]
-        return ConjunctiveQuery(new_content, self.free_vars)
+        return self.builder().remove_atom(atom).build()
 
     def add_atom(self, atom: Atom, fd_set: FunctionalDependencySet, is_key: List[bool],
                  is_consistent: True) -> 'ConjunctiveQuery':
@@ -609,9 +1033,7 @@ class ConjunctiveQuery:
         """
         if atom in self.content:
             return self
-        new_content = copy(self.content)
-        new_content[atom] = (fd_set, is_key, is_consistent)
-        return ConjunctiveQuery(new_content, self.free_vars)
+        return self.builder().add_atom(atom, fd_set, is_key, is_consistent).build()
 
     def decompose_atom(self, atom: Atom, only_variables: bool = False) -> Tuple[List[AtomValue], List[AtomValue], List[AtomValue]]:
         """
@@ -656,6 +1078,92 @@ class ConjunctiveQuery:
         return self.__str__()
 
 
+class ConjunctiveQueryBuilder:
+    """
+    Transient (mutable) version of a ConjunctiveQuery, used to apply several modifications before building a new
+    ConjunctiveQuery. The content of the original query is copied once and everything that is not modified (atoms,
+    FunctionalDependencySets, key positions) is shared with the original query.
+    """
+
+    def __init__(self, q: ConjunctiveQuery) -> None:
+        """
+        Constructor
+        :param q:       The ConjunctiveQuery to start from
+        """
+        self.content = copy(q.content)
+        self.free_vars = copy(q.free_vars)
+        self.renamed = {}
+
+    def remove_atom(self, atom: Atom) -> 'ConjunctiveQueryBuilder':
+        """
+        Removes an atom
+        :param atom:    Atom to be removed.
+        :return:        This builder
+        """
+        if atom in self.content:
+            del self.content[atom]
+            self.renamed.pop(atom, None)
+        return self
+
+    def add_atom(self, atom: Atom, fd_set: FunctionalDependencySet, is_key: List[bool],
+                 is_consistent: True) -> 'ConjunctiveQueryBuilder':
+        """
+        Adds an atom (Nothing is done if the atom is already in the query)
+        :param atom:            Atom to be added.
+        :param fd_set:          Set of FunctionalDependency appearing in atom.
+        :param is_key:          List of bool such that is_key[i] is True iff the position i of atom belongs to the key.
+        :param is_consistent:   True iff atom is consistent.
+        :return:                This builder
+        """
+        if atom not in self.content:
+            self.content[atom] = QueryAtom(atom, fd_set, is_key, is_consistent)
+        return self
+
+    def release_variable(self, var: AtomValue) -> 'ConjunctiveQueryBuilder':
+        """
+        Releases a variable. Only the atoms (and FunctionalDependencySets) where the variable appears are rebuilt.
+        :param var:     A AtomValue object (A variable)
+        :return:        This builder
+        """
+        return self.release_variables([var])
+
+    def release_variables(self, variables: Iterable[AtomValue]) -> 'ConjunctiveQueryBuilder':
+        """
+        Releases a set of variables in one pass. Only the atoms (and FunctionalDependencySets) where one of the
+        variables appears are rebuilt.
+        :param variables:   AtomValue objects (Variables)
+        :return:            This builder
+        """
+        free = set(self.free_vars)
+        new_free = []
+        for var in variables:
+            if var.var and var not in free:
+                free.add(var)
+                new_free.append(var)
+        if len(new_free) == 0:
+            return self
+        released = frozenset(new_free)
+        for atom, data in self.content.items():
+            current = self.renamed.get(atom, atom)
+            if not released.isdisjoint(current.content) or not released.isdisjoint(data.fd_set.variables()):
+                new_atom = current.release_variables(released)
+                self.renamed[atom] = new_atom
+                self.content[atom] = data.release_variables(new_atom, released)
+        self.free_vars += new_free
+        return self
+
+    def build(self) -> ConjunctiveQuery:
+        """
+        Builds the ConjunctiveQuery. The builder should not be used afterwards.
+        :return:        A new ConjunctiveQuery
+        """
+        content = self.content
+        if self.renamed:
+            # Released atoms are equal to their original version : keys are replaced while keeping the order
+            content = {self.renamed.get(atom, atom): content[atom] for atom in content}
+        return ConjunctiveQuery(content, self.free_vars)
+
+
 class SequentialProof:
     """
     Class representing a Sequential Proof for a FunctionalDependency.
@@ -772,26 +1280,116 @@ class Database:
         return res
 
 
+class Classification:
+    """
+    Class representing the classification of CERTAINTY(q) : its complexity class, the atoms in the order in which they
+    are rewritten and the cycles that are reduced during the rewriting.
+    """
+    FO = "FO"
+    L = "L"
+    CONP_COMPLETE = "coNP-complete"
+
+    def __init__(self, complexity: str, elimination_order: List[Atom], cycles: List[List[Atom]]):
+        """
+        Constructor
+        :param complexity:          FO, L or CONP_COMPLETE
+        :param elimination_order:   Atoms in the order in which they are rewritten
+        :param cycles:              Cycles reduced during the rewriting (In the order of the reductions)
+        """
+        self.complexity = complexity
+        self.elimination_order = elimination_order
+        self.cycles = cycles
+
+    def __eq__(self, other) -> bool:
+        """
+        Comparator
+        :param other: Another object
+        :return: True if the objects are equal, else returns False
+        """
+        if not isinstance(other, Classification):
+            return NotImplemented
+        return self.complexity == other.complexity and self.elimination_order == other.elimination_order and \
+            self.cycles == other.cycles
+
+    def __str__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        return self.complexity + " : " + str(self.elimination_order) + " " + str(self.cycles)
+
+    def __repr__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        return self.__str__()
+
+
+class RewritingResult:
+    """
+    Class representing the outcome of the rewriting of one query of a batch : the rewriting of CERTAINTY(q) or the
+    error raised while parsing or rewriting the query.
+    """
+
+    def __init__(self, source: Union[str, ConjunctiveQuery], query: ConjunctiveQuery = None,
+                 program: 'DatalogProgram' = None, error: Exception = None, time: float = None,
+                 stats: 'RewritingStats' = None, complexity: str = None):
+        """
+        Constructor
+        :param source:      The query as given to the batch (A ConjunctiveQuery or a string to be parsed)
+        :param query:       The ConjunctiveQuery (None if source could not be parsed)
+        :param program:     The rewriting of CERTAINTY(query) (None if an error occurred)
+        :param error:       The MalformedQuery, NotSelfJoinFreeQuery or CoNPComplete raised for this query, if any
+        :param time:        Time (in seconds) spent rewriting the query
+        :param stats:       The RewritingStats collected while rewriting the query (None if they were not collected)
+        :param complexity:  The complexity class of CERTAINTY(query) found by the rewriting (None if it is unknown)
+        """
+        self.source = source
+        self.query = query
+        self.program = program
+        self.error = error
+        self.time = time
+        self.stats = stats
+        self.complexity = complexity
+
+    def __str__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        if self.error is not None:
+            return str(self.source) + " : " + str(self.error)
+        return str(self.program)
+
+    def __repr__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        return self.__str__()
+
+
 class DatalogProgram:
     """
     Class representing a Datalog program
     """
-    def __init__(self, rules: List[DatalogQuery]):
+    def __init__(self, rules: List[DatalogQuery], complexity: str = None):
         """
         Constructor
-        :param rules: List containing the Datalog rules
+        :param rules:       List containing the Datalog rules
+        :param complexity:  If the program is the rewriting of CERTAINTY(q), the complexity class of CERTAINTY(q)
+                            (Classification.FO or Classification.L)
         """
         self.rules = rules
+        self.complexity = complexity
 
     def __str__(self) -> str:
         """
         String representation
         :return: String representation
         """
-        result = ""
-        for rule in self.rules:
-            result += str(rule) + "\r\n"
-        return result
+        return "".join(str(rule) + "\r\n" for rule in self.rules)
 
     def __repr__(self) -> str:
         """
@@ -4,6 +4,15 @@ class MalformedQuery(Exception):
     """
     def __init__(self, string, data_type):
         super().__init__("%s is not a valid %s" % (string, data_type))
+        self.string = string
+        self.data_type = data_type
+
+    def __reduce__(self):
+        """
+        Pickling support (eg. to send the exception from a worker process)
+        :return: Reconstruction data
+        """
+        return MalformedQuery, (self.string, self.data_type)
 
 
 class NotSelfJoinFreeQuery(Exception):
@@ -13,6 +22,13 @@ class NotSelfJoinFreeQuery(Exception):
     def __init__(self):
         super().__init__("The given query is not self-join free")
 
+    def __reduce__(self):
+        """
+        Pickling support (eg. to send the exception from a worker process)
+        :return: Reconstruction data
+        """
+        return NotSelfJoinFreeQuery, ()
+
 
 class CoNPComplete(Exception):
     """
@@ -20,3 +36,10 @@ class CoNPComplete(Exception):
     """
     def __init__(self):
         super().__init__("CERTAINTY(q) is coNP-complete for the given query")
+
+    def __reduce__(self):
+        """
+        Pickling support (eg. to send the exception from a worker process)
+        :return: Reconstruction data
+        """
+        return CoNPComplete, ()
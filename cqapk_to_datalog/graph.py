@@ -0,0 +1,285 @@
+from typing import Set, List, Dict, Tuple, Iterable, Iterator, Hashable
+
+
+class DiGraph:
+    """
+    Class representing a directed graph.
+    Each node is given an integer id (in insertion order) and the adjacency is stored as sets of ids, so that graph
+    algorithms only manipulate integers. The in-degree of each node is kept up to date.
+    """
+
+    def __init__(self, nodes: Iterable[Hashable] = ()) -> None:
+        """
+        Constructor
+        :param nodes:   Initial nodes of the graph
+        """
+        self.ids = {}
+        self.node_list = []
+        self.succ = []
+        self.pred = []
+        self.in_degrees = []
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node: Hashable) -> int:
+        """
+        Adds a node to the graph (Nothing is done if the node is already in the graph)
+        :param node:    A node
+        :return:        The id of the node
+        """
+        i = self.ids.get(node)
+        if i is None:
+            i = len(self.node_list)
+            self.ids[node] = i
+            self.node_list.append(node)
+            self.succ.append(set())
+            self.pred.append(set())
+            self.in_degrees.append(0)
+        return i
+
+    def add_edge(self, source: Hashable, target: Hashable) -> None:
+        """
+        Adds an edge to the graph. Missing nodes are added.
+        :param source:  Source node
+        :param target:  Target node
+        """
+        i = self.add_node(source)
+        j = self.add_node(target)
+        if j not in self.succ[i]:
+            self.succ[i].add(j)
+            self.pred[j].add(i)
+            self.in_degrees[j] += 1
+
+    def remove_edge(self, source: Hashable, target: Hashable) -> None:
+        """
+        Removes an edge from the graph
+        :param source:  Source node
+        :param target:  Target node
+        """
+        i = self.ids[source]
+        j = self.ids[target]
+        self.succ[i].remove(j)
+        self.pred[j].remove(i)
+        self.in_degrees[j] -= 1
+
+    def remove_node(self, node: Hashable) -> None:
+        """
+        Removes a node and its edges from the graph. The id of the node is not reused.
+        :param node:    A node
+        """
+        i = self.ids.pop(node)
+        for j in self.succ[i]:
+            self.pred[j].discard(i)
+            self.in_degrees[j] -= 1
+        for j in self.pred[i]:
+            self.succ[j].discard(i)
+        self.node_list[i] = None
+        self.succ[i] = set()
+        self.pred[i] = set()
+        self.in_degrees[i] = 0
+
+    def has_node(self, node: Hashable) -> bool:
+        """
+        Returns True if the node is in the graph
+        :param node:    A node
+        :return:        True if node is in the graph, else returns False
+        """
+        return node in self.ids
+
+    def has_edge(self, source: Hashable, target: Hashable) -> bool:
+        """
+        Returns True if the edge is in the graph
+        :param source:  Source node
+        :param target:  Target node
+        :return:        True if the edge is in the graph, else returns False
+        """
+        return source in self.ids and target in self.ids and self.ids[target] in self.succ[self.ids[source]]
+
+    def successors(self, node: Hashable) -> List[Hashable]:
+        """
+        Returns the successors of a node
+        :param node:    A node
+        :return:        A list containing the successors of node
+        """
+        return [self.node_list[j] for j in self.succ[self.ids[node]]]
+
+    def predecessors(self, node: Hashable) -> List[Hashable]:
+        """
+        Returns the predecessors of a node
+        :param node:    A node
+        :return:        A list containing the predecessors of node
+        """
+        return [self.node_list[j] for j in self.pred[self.ids[node]]]
+
+    def in_degree(self, node: Hashable) -> int:
+        """
+        Returns the in-degree of a node
+        :param node:    A node
+        :return:        The number of edges entering node
+        """
+        return self.in_degrees[self.ids[node]]
+
+    @property
+    def nodes(self) -> List[Hashable]:
+        """
+        Nodes of the graph (In insertion order)
+        """
+        return [node for node in self.node_list if node is not None]
+
+    @property
+    def edges(self) -> Set[Tuple[Hashable, Hashable]]:
+        """
+        Edges of the graph
+        """
+        return {(self.node_list[i], self.node_list[j]) for i in self.ids.values() for j in self.succ[i]}
+
+    def __len__(self) -> int:
+        """
+        Returns the number of nodes
+        :return:    The number of nodes
+        """
+        return len(self.ids)
+
+    def __contains__(self, node: Hashable) -> bool:
+        """
+        Returns True if the node is in the graph
+        :param node:    A node
+        :return:        True if node is in the graph, else returns False
+        """
+        return node in self.ids
+
+    def _component_ids(self) -> List[List[int]]:
+        """
+        Computes the strongly connected components with an iterative version of Tarjan's algorithm
+        :return:    A list containing the ids of the nodes of each strongly connected component
+        """
+        index = {}
+        low = {}
+        on_stack = set()
+        stack = []
+        components = []
+        for root in self.ids.values():
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.succ[root]))]
+            while work:
+                i, children = work[-1]
+                pushed = False
+                for j in children:
+                    if j not in index:
+                        index[j] = low[j] = len(index)
+                        stack.append(j)
+                        on_stack.add(j)
+                        work.append((j, iter(self.succ[j])))
+                        pushed = True
+                        break
+                    elif j in on_stack:
+                        low[i] = min(low[i], index[j])
+                if pushed:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[i])
+                if low[i] == index[i]:
+                    component = []
+                    while True:
+                        j = stack.pop()
+                        on_stack.remove(j)
+                        component.append(j)
+                        if j == i:
+                            break
+                    components.append(component)
+        return components
+
+    def strongly_connected_components(self) -> List[Set[Hashable]]:
+        """
+        Returns the strongly connected components of the graph
+        :return:    A list containing the set of nodes of each strongly connected component
+        """
+        return [{self.node_list[i] for i in component} for component in self._component_ids()]
+
+    def initial_strong_components(self) -> List[Set[Hashable]]:
+        """
+        Returns the initial strong components of the graph ie. the strongly connected components that have no
+        incoming edge from another component
+        :return:    A list containing the set of nodes of each initial strong component
+        """
+        res = []
+        for component in self._component_ids():
+            ids = set(component)
+            if all(self.pred[i].issubset(ids) for i in component):
+                res.append({self.node_list[i] for i in component})
+        return res
+
+    def find_cycle(self) -> List[Hashable]:
+        """
+        Finds a cycle with an iterative depth first search
+        :return:    The nodes of a cycle (In the order of the edges) or None if the graph is acyclic
+        """
+        state = {}
+        for root in self.ids.values():
+            if root in state:
+                continue
+            state[root] = 1
+            path = [root]
+            work = [iter(self.succ[root])]
+            while work:
+                pushed = False
+                for j in work[-1]:
+                    if state.get(j) == 1:
+                        return [self.node_list[i] for i in path[path.index(j):]]
+                    if j not in state:
+                        state[j] = 1
+                        path.append(j)
+                        work.append(iter(self.succ[j]))
+                        pushed = True
+                        break
+                if not pushed:
+                    state[path.pop()] = 2
+                    work.pop()
+        return None
+
+    def simple_cycles(self) -> Iterator[List[Hashable]]:
+        """
+        Yields the simple cycles of the graph, one at a time. Each cycle is enumerated once, from its node of smallest
+        id, by a backtracking search restricted to the strongly connected component of that node.
+        :return:    A generator of cycles (Lists of nodes in the order of the edges)
+        """
+        component_of = {}
+        for k, component in enumerate(self._component_ids()):
+            for i in component:
+                component_of[i] = k
+        for start in sorted(self.ids.values()):
+            allowed = [j for j in self.succ[start] if j >= start and component_of[j] == component_of[start]]
+            path = [start]
+            on_path = {start}
+            work = [iter(allowed)]
+            while work:
+                pushed = False
+                for j in work[-1]:
+                    if j == start:
+                        yield [self.node_list[i] for i in path]
+                    elif j not in on_path and j > start and component_of[j] == component_of[start]:
+                        path.append(j)
+                        on_path.add(j)
+                        work.append(iter(self.succ[j]))
+                        pushed = True
+                        break
+                if not pushed:
+                    on_path.discard(path.pop())
+                    work.pop()
+
+    def to_networkx(self) -> 'networkx.DiGraph':
+        """
+        Exports the graph as a networkx DiGraph (eg. to draw it). networkx is only needed by this method.
+        :return:    A networkx DiGraph with the same nodes and edges
+        """
+        import networkx
+        g = networkx.DiGraph()
+        g.add_nodes_from(self.nodes)
+        g.add_edges_from(self.edges)
+        return g
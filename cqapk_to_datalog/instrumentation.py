@@ -0,0 +1,161 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator
+
+# Stats being collected (None when the instrumentation is disabled)
+_active = None
+
+# Code flag of the generator functions (inspect.CO_GENERATOR, inspect being slow to import)
+_CO_GENERATOR = 0x20
+
+
+class RewritingStats:
+    """
+    Class representing the statistics collected during a rewriting : the wall time and the number of calls of each
+    phase (including the construction of each rule template) and the number of calls of the hot primitives.
+    The time of a phase includes the time of the phases it calls.
+    Each step of the rewriting is recorded under the name of the step (rewrite_fo, saturate or reduce_cycle) for the
+    generation of its rules and under <step>.query for the computation of the query left after the step. The search of
+    the cycle to reduce is recorded as get_reductible_sets and the closures of sets of variables are counted as
+    closure_mask (one closure) and closure_masks (several closures at once).
+    """
+
+    def __init__(self) -> None:
+        """
+        Constructor
+        """
+        self.times = Counter()
+        self.calls = Counter()
+        self.counters = Counter()
+
+    def add_phase(self, name: str, elapsed: float, calls: int = 1) -> None:
+        """
+        Records calls of a phase
+        :param name:        Name of the phase
+        :param elapsed:     Wall time (in seconds) spent in the phase
+        :param calls:       Number of calls
+        """
+        self.times[name] += elapsed
+        self.calls[name] += calls
+
+    def update(self, other: 'RewritingStats') -> None:
+        """
+        Adds the statistics of another RewritingStats to this one
+        :param other:   A RewritingStats
+        """
+        self.times.update(other.times)
+        self.calls.update(other.calls)
+        self.counters.update(other.counters)
+
+    def to_dict(self) -> Dict[str, Dict[str, object]]:
+        """
+        Returns the statistics as plain dicts (eg. to dump them as JSON)
+        :return:    A dict with the phases ({name: {"time": seconds, "calls": n}}) and the counters ({name: n})
+        """
+        return {"phases": {name: {"time": self.times[name], "calls": self.calls[name]} for name in sorted(self.calls)},
+                "counters": dict(sorted(self.counters.items()))}
+
+    def __str__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        lines = ["%s : %.6fs (%d calls)" % (name, self.times[name], self.calls[name])
+                 for name in sorted(self.calls, key=lambda name: -self.times[name])]
+        lines += ["%s : %d" % (name, n) for name, n in sorted(self.counters.items())]
+        return "\n".join(lines)
+
+    def __repr__(self) -> str:
+        """
+        String representation
+        :return: String representation
+        """
+        return self.__str__()
+
+
+@contextmanager
+def collect_stats() -> Iterator[RewritingStats]:
+    """
+    Collects the statistics of the rewritings done in the with block (in this process)
+    :return:    A context manager giving the RewritingStats being filled
+    """
+    global _active
+    previous = _active
+    stats = RewritingStats()
+    _active = stats
+    try:
+        yield stats
+    finally:
+        _active = previous
+        if previous is not None:
+            previous.update(stats)
+
+
+def phase(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator timing a function as a phase of the rewriting. When no stats are collected, the only overhead is a test.
+    The time of a generator function is the time spent computing its values.
+    :param name:    Name of the phase
+    :return:        The decorator
+    """
+    def decorator(f):
+        if f.__code__.co_flags & _CO_GENERATOR:
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if _active is None:
+                    yield from f(*args, **kwargs)
+                    return
+                stats = _active
+                stats.calls[name] += 1
+                values = f(*args, **kwargs)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        value = next(values)
+                    except StopIteration:
+                        stats.times[name] += time.perf_counter() - start
+                        return
+                    stats.times[name] += time.perf_counter() - start
+                    yield value
+        else:
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                stats = _active
+                if stats is None:
+                    return f(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    stats.add_phase(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def add_counters(prefix: str, counters: Counter) -> None:
+    """
+    Adds counts to the counters of the stats being collected (Does nothing when no stats are collected)
+    :param prefix:      Prefix of the names of the counters (The counter of a key is named prefix.key)
+    :param counters:    A Counter
+    """
+    if _active is not None:
+        for key, n in counters.items():
+            _active.counters[prefix + "." + key] += n
+
+
+def counted(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator counting the calls of a function (For hot primitives, whose calls are too short to be timed)
+    :param name:    Name of the counter
+    :return:        The decorator
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _active is not None:
+                _active.counters[name] += 1
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -2,7 +2,7 @@ import re
 from cqapk_to_datalog.data_structures import AtomValue, Atom, ConjunctiveQuery, FunctionalDependency, \
     FunctionalDependencySet
 from cqapk_to_datalog.exceptions import MalformedQuery
-from typing import List, Tuple
+from typing import List, Tuple, Iterator
 
 
 def parse_atoms(string) -> List[Tuple[Atom, FunctionalDependencySet, List[bool], bool]]:
@@ -56,12 +56,9 @@ def parse_atom(string) -> Tuple[Atom, FunctionalDependencySet, List[bool], bool]
 
 
 def parse_fd_set(content, is_key) -> FunctionalDependencySet:
-    fd_set = FunctionalDependencySet()
     key_vars = [content[i] for i in range(len(content)) if is_key[i] and content[i].var]
     other_vars = [value for value in content if value not in key_vars]
-    for var in other_vars:
-        fd_set.add(FunctionalDependency(key_vars, var))
-    return fd_set
+    return FunctionalDependencySet([FunctionalDependency(key_vars, var) for var in other_vars])
 
 
 def parse_atoms_values(string) -> List[AtomValue]:
@@ -101,10 +98,7 @@ def parse_query(string):
             q = ConjunctiveQuery()
             for atom, fd_set, is_key, is_consistent in parse_atoms(query_body):
                 q = q.add_atom(atom, fd_set, is_key, is_consistent)
-            for value in free_vars:
-                if value.var:
-                    q = q.release_variable(value)
-            return q
+            return q.release_variables(free_vars)
         except MalformedQuery:
             raise
 
@@ -116,13 +110,18 @@ def clean_line(string) -> str:
     return string.replace(" ", "").replace("\n", "").replace("\t", "")
 
 
+def read_queries_from_file(file_name) -> Iterator[str]:
+    """
+    Reads the queries of a file without parsing them, one line at a time (Empty lines and comments are skipped)
+    :param file_name:   Path of the file
+    :return:            A generator of the cleaned strings of the queries
+    """
+    with open(file_name, 'r') as file:
+        for query in file:
+            clean = clean_line(query)
+            if len(clean) > 0 and clean[0] != "#":
+                yield clean
+
+
 def parse_queries_from_file(file_name) -> List[ConjunctiveQuery]:
-    file = open(file_name, 'r')
-    queries = []
-    for query in file.readlines():
-        clean = clean_line(query)
-        if len(clean) > 0 and clean[0] != "#":            
-            q = parse_query(clean)
-            queries.append(q)
-    file.close()
-    return queries
+    return [parse_query(query) for query in read_queries_from_file(file_name)]
@@ -1,9 +1,9 @@
-import regex
 from cqapk_to_datalog.data_structures import DatalogQuery, Atom, AtomValue, EqualityAtom, CompareAtom, DatalogProgram
 from cqapk_to_datalog.exceptions import MalformedQuery
 
 
 def read_datalog_file(file: str) -> DatalogProgram:
+    import regex
     f = open(file, "r")
     names_regex = "[A-Za-z][A-Za-z0-9_]*"
     atom_regex = names_regex + "(\(" + "(" + names_regex + ",)*" + names_regex + "\))?"
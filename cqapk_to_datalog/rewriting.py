@@ -1,46 +1,252 @@
 import cqapk_to_datalog.algorithms as algorithms
 import cqapk_to_datalog.data_structures as structures
 import cqapk_to_datalog.rules_templates as templates
-from typing import List, Tuple, FrozenSet, Set, Dict
-from cqapk_to_datalog.exceptions import NotSelfJoinFreeQuery, CoNPComplete
+from typing import List, Tuple, FrozenSet, Set, Dict, Iterator, Iterable, Union, Callable, TextIO
+import time
+from collections import deque
+from cqapk_to_datalog.exceptions import NotSelfJoinFreeQuery, CoNPComplete, MalformedQuery
+from cqapk_to_datalog.canonical import canonicalize
+from cqapk_to_datalog.cache import RewritingCache, plain_program
+from cqapk_to_datalog.parsers.cq_parser import parse_query
+from cqapk_to_datalog.instrumentation import phase, collect_stats
 
+# Kinds of the steps yielded by rewriting_steps
+FO_STEP = "fo"
+SATURATION_STEP = "saturation"
+REDUCTION_STEP = "reduction"
 
-def rewrite(q: structures.ConjunctiveQuery) -> structures.DatalogProgram:
+
+@phase("rewrite")
+def rewrite(q: structures.ConjunctiveQuery, cache: RewritingCache = None) -> structures.DatalogProgram:
     """
     Main rewriting algorithm.
+    :param q:       A ConjunctiveQuery.
+    :param cache:   If given, the rewriting of the canonical form of q is looked up in (or added to) this cache and
+                    renamed back to the names of q
+    :return:        A List of DatalogQueries representing a Datalog program which is the rewriting of CERTAINTY(q).
+    """
+    if cache is not None:
+        canonical_q = canonicalize(q)
+        if canonical_q.restorable:
+            program = cache.get(canonical_q.key)
+            if program is None:
+                program = rewritten_program(canonical_q.query)
+                cache.put(canonical_q.key, program)
+            return canonical_q.restore(program)
+    return rewritten_program(q)
+
+
+def rewritten_program(q: structures.ConjunctiveQuery) -> structures.DatalogProgram:
+    """
+    Builds the rewriting of CERTAINTY(q) (See rewrite) and records the complexity class of CERTAINTY(q) on it
     :param q:   A ConjunctiveQuery.
-    :return:    A List of DatalogQueries representing a Datalog program which is the rewriting of CERTAINTY(q).
+    :return:    The DatalogProgram rewriting CERTAINTY(q)
+    """
+    classification = structures.Classification(structures.Classification.FO, [], [])
+    rules = list(rewrite_iter(q, classification))
+    return structures.DatalogProgram(rules, classification.complexity)
+
+
+def rewrite_iter(q: structures.ConjunctiveQuery,
+                 classification: structures.Classification = None) -> Iterator[structures.DatalogQuery]:
+    """
+    Generates the rewriting of CERTAINTY(q) one rule at a time : the rules of each step (rewrite_fo, saturate or
+    reduce_cycle) are yielded as soon as the step is done, so that the whole program is never held in memory.
+    NotSelfJoinFreeQuery and CoNPComplete are raised before the first rule is yielded.
+    :param q:               A ConjunctiveQuery.
+    :param classification:  If given, the rewritten atoms and the reduced cycles are added to it as the steps are done
+                            and its complexity is set to L when a cycle is reduced (See classify)
+    :return:                A generator of the DatalogQueries of the rewriting of CERTAINTY(q) (In the order of rewrite)
     """
-    if not algorithms.is_self_join_free(q):
-        raise NotSelfJoinFreeQuery
-    output_rules = []
     done = set()
     fo_index = 0
     reduction_index = 0
+    for step, current_q, data in rewriting_steps(q):
+        if step == FO_STEP:
+            if classification is not None:
+                classification.elimination_order.append(data)
+            yield from fo_rules(current_q, data, len(current_q.content) == 1, done, fo_index)
+            done.add(data)
+            fo_index += 1
+        elif step == SATURATION_STEP:
+            yield from saturation_rules(current_q, data)
+        else:
+            if classification is not None:
+                classification.complexity = structures.Classification.L
+                classification.cycles.append(data)
+            yield from iter_reduction_rules(data, current_q, reduction_index)
+            reduction_index += 1
+
+
+def write_rewriting(q: structures.ConjunctiveQuery, sink: TextIO) -> int:
+    """
+    Writes the rewriting of CERTAINTY(q) into a sink as it is generated by rewrite_iter (With the same format as
+    DatalogProgram.__str__)
+    :param q:       A ConjunctiveQuery.
+    :param sink:    A text file (or any object with a write method)
+    :return:        The number of rules written
+    """
+    n_rules = 0
+    for rule in rewrite_iter(q):
+        sink.write(str(rule) + "\r\n")
+        n_rules += 1
+    return n_rules
+
+
+@phase("classify")
+def classify(q: structures.ConjunctiveQuery) -> structures.Classification:
+    """
+    Classifies CERTAINTY(q) without generating the Datalog rules.
+    :param q:   A ConjunctiveQuery.
+    :return:    A Classification containing the complexity class of CERTAINTY(q), the atoms in the order in which they
+                are rewritten and the cycles that are reduced.
+    """
+    elimination_order = []
+    cycles = []
+    try:
+        for step, _, data in rewriting_steps(q):
+            if step == FO_STEP:
+                elimination_order.append(data)
+            elif step == REDUCTION_STEP:
+                cycles.append(data)
+    except CoNPComplete:
+        return structures.Classification(structures.Classification.CONP_COMPLETE, [], [])
+    if len(cycles) > 0:
+        return structures.Classification(structures.Classification.L, elimination_order, cycles)
+    return structures.Classification(structures.Classification.FO, elimination_order, cycles)
+
+
+def rewrite_many(queries: Iterable[Union[str, structures.ConjunctiveQuery]], workers: int = 1,
+                 cache: RewritingCache = None,
+                 formatter: Callable[[structures.RewritingResult], object] = None,
+                 stats: bool = False, context: 'multiprocessing.context.BaseContext' = None) -> Iterator[object]:
+    """
+    Rewrites a batch of queries, possibly in parallel. The results are yielded in the order of the queries, and a query
+    that cannot be parsed or rewritten gives a result holding the error instead of stopping the batch.
+    :param queries:     The queries to rewrite (ConjunctiveQueries or strings that are parsed with parse_query)
+    :param workers:     Number of worker processes (The queries are rewritten in this process if workers <= 1)
+    :param cache:       If given, the cache used by rewrite (Each worker process uses its own copy of it, a DiskCache
+                        is shared through its file)
+    :param formatter:   If given, function applied to each RewritingResult (in the worker process) whose value is
+                        yielded instead of the result. Formatting the output in the workers avoids sending the
+                        programs back to this process.
+    :param stats:       If True, the RewritingStats of each query are collected (See instrumentation)
+    :param context:     If given, the multiprocessing context used to start the worker processes (eg. spawn)
+    :return:            A generator of RewritingResults (or of the values returned by formatter)
+    """
+    if workers <= 1:
+        for q in queries:
+            result = rewrite_one(q, cache, stats)
+            yield result if formatter is None else formatter(result)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    # Only a bounded number of queries are submitted ahead of the one being yielded, so that the batch is consumed
+    # lazily and the results do not pile up in memory
+    pending = deque()
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(cache, formatter, stats)) as executor:
+        for q in queries:
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_rewrite_in_worker, q))
+        while pending:
+            yield pending.popleft().result()
+
+
+def rewrite_one(q: Union[str, structures.ConjunctiveQuery], cache: RewritingCache = None,
+                stats: bool = False) -> structures.RewritingResult:
+    """
+    Parses (if needed) and rewrites a query of a batch (See rewrite_many)
+    :param q:       A ConjunctiveQuery or a string to be parsed with parse_query
+    :param cache:   If given, the cache used by rewrite
+    :param stats:   If True, the RewritingStats of the query are collected
+    :return:        A RewritingResult
+    """
+    if stats:
+        with collect_stats() as collected:
+            result = rewrite_one(q, cache)
+        result.stats = collected
+        return result
+    query = None
+    start = time.perf_counter()
+    try:
+        query = parse_query(q) if isinstance(q, str) else q
+        start = time.perf_counter()
+        program = rewrite(query, cache)
+        return structures.RewritingResult(q, query, program, time=time.perf_counter() - start,
+                                          complexity=program.complexity)
+    except CoNPComplete as error:
+        return structures.RewritingResult(q, query, error=error, time=time.perf_counter() - start,
+                                          complexity=structures.Classification.CONP_COMPLETE)
+    except (MalformedQuery, NotSelfJoinFreeQuery) as error:
+        return structures.RewritingResult(q, query, error=error, time=time.perf_counter() - start)
+
+
+_worker_cache = None
+_worker_formatter = None
+_worker_stats = False
+
+
+def _init_worker(cache: RewritingCache, formatter: Callable[[structures.RewritingResult], object],
+                 stats: bool) -> None:
+    """
+    Initializes a worker process of rewrite_many
+    :param cache:       The cache used by the worker
+    :param formatter:   The function applied to the results (or None)
+    :param stats:       True if the RewritingStats of the queries are collected
+    """
+    global _worker_cache, _worker_formatter, _worker_stats
+    _worker_cache = cache
+    _worker_formatter = formatter
+    _worker_stats = stats
+
+
+def _rewrite_in_worker(q: Union[str, structures.ConjunctiveQuery]) -> object:
+    """
+    Rewrites a query of a batch in a worker process. The rules of the program are replaced by plain DatalogQueries
+    before being sent back.
+    :param q:   A ConjunctiveQuery or a string to be parsed with parse_query
+    :return:    A RewritingResult (or the value returned by the formatter)
+    """
+    result = rewrite_one(q, _worker_cache, _worker_stats)
+    if _worker_formatter is not None:
+        return _worker_formatter(result)
+    if result.program is not None:
+        result.program = plain_program(result.program)
+    return result
+
+
+def rewriting_steps(q: structures.ConjunctiveQuery) -> Iterator[Tuple[str, structures.ConjunctiveQuery, object]]:
+    """
+    Yields the steps of the rewriting of CERTAINTY(q) without generating the Datalog rules. Each step is a tuple
+    (kind, query, data) where query is the ConjunctiveQuery the step is applied to and data is the rewritten Atom
+    (FO_STEP), the bad internal FDs (SATURATION_STEP) or the reduced cycle (REDUCTION_STEP).
+    :param q:   A ConjunctiveQuery.
+    :return:    A generator of steps.
+    """
+    if not algorithms.is_self_join_free(q):
+        raise NotSelfJoinFreeQuery
+    reduction_index = 0
     current_q = q
     a_graph = algorithms.gen_attack_graph(current_q)
-    if algorithms.all_cycles_weak(a_graph, current_q):
-        while len(a_graph.nodes) > 0:
-            not_attacked_atoms = [atom for atom in current_q.get_atoms() if a_graph.in_degree(atom) == 0]
-            if len(not_attacked_atoms) > 0:
-                atom = not_attacked_atoms[0]
-                current_q, new_rules = rewrite_fo(current_q, atom, len(a_graph.nodes) == 1, done, fo_index)
-                done.add(atom)
-                fo_index += 1
-                output_rules += new_rules
-            else:
-                bad = algorithms.find_bad_internal_fd(current_q)
-                if len(bad) != 0:
-                    current_q, saturation_rules = saturate(current_q, bad)
-                    output_rules += saturation_rules
-                reducible_cycle = algorithms.get_reductible_sets(current_q, a_graph)[0]
-                current_q, new_rules = reduce_cycle(reducible_cycle, current_q, reduction_index)
-                reduction_index += 1
-                output_rules += new_rules
-            a_graph = algorithms.gen_attack_graph(current_q)
-        return structures.DatalogProgram(output_rules)
-    else:
+    if not algorithms.all_cycles_weak(a_graph, current_q):
         raise CoNPComplete
+    while len(a_graph) > 0:
+        not_attacked_atoms = [atom for atom in current_q.get_atoms() if a_graph.in_degree(atom) == 0]
+        if len(not_attacked_atoms) > 0:
+            atom = not_attacked_atoms[0]
+            yield FO_STEP, current_q, atom
+            current_q = remove_fo_atom(current_q, atom)
+        else:
+            bad = algorithms.find_bad_internal_fd(current_q, a_graph)
+            if len(bad) != 0:
+                yield SATURATION_STEP, current_q, bad
+                current_q = saturated_query(current_q, bad)
+            reducible_cycle = algorithms.get_reductible_set(current_q, a_graph)
+            yield REDUCTION_STEP, current_q, reducible_cycle
+            current_q = reduced_query(reducible_cycle, current_q, reduction_index)
+            reduction_index += 1
+        a_graph.update(current_q)
 
 
 def rewrite_fo(q: structures.ConjunctiveQuery, atom: structures.Atom, is_last: bool, done: Set[structures.Atom],
@@ -55,6 +261,21 @@ def rewrite_fo(q: structures.ConjunctiveQuery, atom: structures.Atom, is_last: b
     :return:                        A list of Datalog rules and a ConjunctiveQuery that corresponds to q\{atom} where
                                     the variables in atoms are constants.
     """
+    return remove_fo_atom(q, atom), fo_rules(q, atom, is_last, done, index)
+
+
+@phase("rewrite_fo")
+def fo_rules(q: structures.ConjunctiveQuery, atom: structures.Atom, is_last: bool, done: Set[structures.Atom],
+             index) -> List[structures.DatalogQuery]:
+    """
+    Generates the Datalog rules rewriting CERTAINTY(q) in function of a given atom (See rewrite_fo)
+    :param q:                       A sjfBCQ
+    :param atom:					Atom being rewrited
+    :param is_last:					True if q without atom has already been treated
+    :param done:                    A set of the Atom that have already been treated by the rewriting process
+    :param index:                   Index used to enumerate the Datalog rules
+    :return:                        A list of Datalog rules
+    """
     rules = []
     data = templates.RewritingData(q, atom, index, is_last, done)
     rules.append(templates.RewriteAtomQuery(data))
@@ -62,10 +283,19 @@ def rewrite_fo(q: structures.ConjunctiveQuery, atom: structures.Atom, is_last: b
         rules.append(templates.BadBlockQuery(data))
         if data.has_c:
             rules.append(templates.GoodFactQuery(data))
-    new_q = q.remove_atom(atom)
-    for var in data.v:
-        new_q = new_q.release_variable(var)
-    return new_q, rules
+    return rules
+
+
+@phase("rewrite_fo.query")
+def remove_fo_atom(q: structures.ConjunctiveQuery, atom: structures.Atom) -> structures.ConjunctiveQuery:
+    """
+    Returns the query left once CERTAINTY(q) has been rewritten in function of a given atom (See rewrite_fo)
+    :param q:                       A sjfBCQ
+    :param atom:					Atom being rewrited
+    :return:                        A ConjunctiveQuery that corresponds to q without atom where the variables in atoms are
+                                    constants.
+    """
+    return q.builder().remove_atom(atom).release_variables(atom.variables()).build()
 
 
 def reduce_cycle(cycle: List[structures.Atom], q: structures.ConjunctiveQuery,
@@ -78,46 +308,91 @@ def reduce_cycle(cycle: List[structures.Atom], q: structures.ConjunctiveQuery,
     :return: 					A list of Datalog rules and a ConjunctiveQuery that corresponds to
                                 q\{atom} U {T} U {Nc} (Just as described in the report)
     """
-    rules = []
+    return reduced_query(cycle, q, rewriting_index), reduction_rules(cycle, q, rewriting_index)
+
+
+def reduction_rules(cycle: List[structures.Atom], q: structures.ConjunctiveQuery,
+                    rewriting_index: int) -> List[structures.DatalogQuery]:
+    """
+    Generates the Datalog rules of the reduction of a cycle (See reduce_cycle)
+    :param cycle:				Cycle to be reduced
+    :param q: 					A ConjunctiveQuery
+    :param rewriting_index: 	Index used to enumerate the Datalog rules
+    :return: 					A list of Datalog rules
+    """
+    return list(iter_reduction_rules(cycle, q, rewriting_index))
+
+
+@phase("reduce_cycle")
+def iter_reduction_rules(cycle: List[structures.Atom], q: structures.ConjunctiveQuery,
+                         rewriting_index: int) -> Iterator[structures.DatalogQuery]:
+    """
+    Generates the Datalog rules of the reduction of a cycle one at a time (See reduction_rules)
+    :param cycle:				Cycle to be reduced
+    :param q: 					A ConjunctiveQuery
+    :param rewriting_index: 	Index used to enumerate the Datalog rules
+    :return: 					A generator of Datalog rules
+    """
     k = len(cycle)
     renamings = algorithms.generate_renaming(2 * k + 2, list(q.get_all_variables()))
-    rules += [templates.EqQuery(atom, q) for atom in cycle]
-    rules += [templates.NeqQuery(atom, q, renamings[0]) for atom in cycle]
-    rules += garbage_set_rules(cycle, q, rewriting_index, renamings)
-    rules += new_atoms_rules(cycle, q, rewriting_index, renamings)
-    t, n_atoms = new_atoms(cycle, q, rewriting_index, renamings[0])
-    new_q = q.add_atom(*t)
+    for atom in cycle:
+        yield templates.EqQuery(atom, q)
+    for atom in cycle:
+        yield templates.NeqQuery(atom, q, renamings[0])
+    yield from garbage_set_rules(cycle, q, rewriting_index, renamings)
+    yield from new_atoms_rules(cycle, q, rewriting_index, renamings)
+
+
+@phase("reduce_cycle.query")
+def reduced_query(cycle: List[structures.Atom], q: structures.ConjunctiveQuery,
+                  rewriting_index: int) -> structures.ConjunctiveQuery:
+    """
+    Returns the query obtained by the reduction of a cycle (See reduce_cycle)
+    :param cycle:				Cycle to be reduced
+    :param q: 					A ConjunctiveQuery
+    :param rewriting_index: 	Index used to enumerate the Datalog rules
+    :return: 					A ConjunctiveQuery that corresponds to q without the cycle plus T and the atoms Nc
+    """
+    renaming = algorithms.generate_renaming(1, list(q.get_all_variables()))[0]
+    t, n_atoms = new_atoms(cycle, q, rewriting_index, renaming)
+    builder = q.builder().add_atom(*t)
     for n_atom in n_atoms:
-        new_q = new_q.add_atom(*n_atom)
+        builder.add_atom(*n_atom)
     for atom in cycle:
-        new_q = new_q.remove_atom(atom)
-    return new_q, rules
+        builder.remove_atom(atom)
+    return builder.build()
 
 
 def garbage_set_rules(cycle: List[structures.Atom], q: structures.ConjunctiveQuery, rewriting_index: int,
-                      renamings: List[Dict[structures.AtomValue, structures.AtomValue]]):
+                      renamings: List[Dict[structures.AtomValue, structures.AtomValue]]) \
+        -> Iterator[structures.DatalogQuery]:
     """
     Generated the Datalog rules needed to compute the maximum garbage set of a cycle C in the M-graph of q.
     :param cycle:				A cycle in the M-graph of q
     :param q:					A ConjunctiveQuery
     :param rewriting_index: 	Index used to enumerate the Datalog rules
     :param renamings:           Necessary renamings
-    :return:
+    :return:                    A generator of Datalog rules (Each rule is built when it is needed)
     """
-    rules = []
-    rules += [templates.RelevantQuery(atom, q) for atom in cycle]
-    rules += [templates.GarbageRelevantQuery(atom, q) for atom in cycle]
-    rules += [templates.Any1EmbQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.Rel1EmbQuery(cycle, q, rewriting_index)]
-    rules += [templates.Irr1EmbQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.Garbage1EmbQuery(atom, cycle, q, rewriting_index, renamings) for atom in cycle]
-    rules += [templates.PkQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.DConBaseQuery(cycle, q, rewriting_index, renamings),
-              templates.DConRecQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.InLongDCycleQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.GarbageLongCycleQuery(atom, cycle, q, rewriting_index) for atom in cycle]
-    rules += [templates.GarbagePropagateQuery(atom1, atom2, q) for atom1 in cycle for atom2 in cycle if atom1 != atom2]
-    return rules
+    for atom in cycle:
+        yield templates.RelevantQuery(atom, q)
+    for atom in cycle:
+        yield templates.GarbageRelevantQuery(atom, q)
+    yield templates.Any1EmbQuery(cycle, q, rewriting_index, renamings)
+    yield templates.Rel1EmbQuery(cycle, q, rewriting_index)
+    yield templates.Irr1EmbQuery(cycle, q, rewriting_index, renamings)
+    for atom in cycle:
+        yield templates.Garbage1EmbQuery(atom, cycle, q, rewriting_index, renamings)
+    yield templates.PkQuery(cycle, q, rewriting_index, renamings)
+    yield templates.DConBaseQuery(cycle, q, rewriting_index, renamings)
+    yield templates.DConRecQuery(cycle, q, rewriting_index, renamings)
+    yield templates.InLongDCycleQuery(cycle, q, rewriting_index, renamings)
+    for atom in cycle:
+        yield templates.GarbageLongCycleQuery(atom, cycle, q, rewriting_index)
+    for atom1 in cycle:
+        for atom2 in cycle:
+            if atom1 != atom2:
+                yield templates.GarbagePropagateQuery(atom1, atom2, q)
 
 
 def new_atoms(cycle: List[structures.Atom], q: structures.ConjunctiveQuery, rewriting_index: int,
@@ -141,45 +416,44 @@ def new_atoms(cycle: List[structures.Atom], q: structures.ConjunctiveQuery, rewr
         _, x, y = q.decompose_atom(atom)
         n = structures.Atom("N_" + atom.name, x + x_0_ren, atom.released)
         t_released = t_released.union(atom.released)
-        fd = structures.FunctionalDependencySet()
-        for var in x_0_ren:
-            fd.add(structures.FunctionalDependency(x, var))
+        fd = structures.FunctionalDependencySet([structures.FunctionalDependency(x, var) for var in x_0_ren])
         is_key = [True] * len(x) + [False] * len(x_0_ren)
         n_atoms.append((n, fd, is_key, True))
         t_content += x
         t_content += y
     t = structures.Atom("T_" + str(rewriting_index), x_0_ren + t_content, t_released)
-    fd = structures.FunctionalDependencySet()
-    for var in t_content:
-        fd.add(structures.FunctionalDependency(x_0_ren, var))
+    fd = structures.FunctionalDependencySet([structures.FunctionalDependency(x_0_ren, var) for var in t_content])
     is_key = [True] * len(x_0_ren) + [False] * len(t_content)
     return (t, fd, is_key, False), n_atoms
 
 
 def new_atoms_rules(cycle: List[structures.Atom], q: structures.ConjunctiveQuery, rewriting_index : int,
-                    renamings: List[Dict[structures.AtomValue, structures.AtomValue]]) -> List[structures.DatalogQuery]:
+                    renamings: List[Dict[structures.AtomValue, structures.AtomValue]]) \
+        -> Iterator[structures.DatalogQuery]:
     """
     Generated the rules defining the new atoms added by the reduction
     :param cycle: 				Cycle being reduced
     :param q: 					A ConjunctiveQuery
     :param rewriting_index: 	Index used to enumerate the Datalog rules
     :param renamings: 			Necessary renamings
-    :return: 					Rules defining the new atoms
+    :return: 					A generator of the rules defining the new atoms (Each rule is built when it is needed)
     """
     _, x_0, _ = q.decompose_atom(cycle[0])
-    rules = []
-    rules += [templates.KeepQuery(atom, q) for atom in cycle]
-    rules += [templates.LinkQuery(atom, cycle, q, rewriting_index, renamings[0]) for atom in cycle]
-    rules += [templates.TransBaseQuery(cycle, q, rewriting_index, renamings[0])]
-    rules += [templates.TransRecQuery(cycle, q, rewriting_index, renamings)]
+    for atom in cycle:
+        yield templates.KeepQuery(atom, q)
+    for atom in cycle:
+        yield templates.LinkQuery(atom, cycle, q, rewriting_index, renamings[0])
+    yield templates.TransBaseQuery(cycle, q, rewriting_index, renamings[0])
+    yield templates.TransRecQuery(cycle, q, rewriting_index, renamings)
     if len(x_0) > 1:
-        rules += [templates.LowerCompositeQuery(cycle, q, i, rewriting_index, renamings) for i in range(len(x_0))]
+        for i in range(len(x_0)):
+            yield templates.LowerCompositeQuery(cycle, q, i, rewriting_index, renamings)
     else:
-        rules += [templates.LowerSingleQuery(cycle, q, rewriting_index, renamings)]
-    rules += [templates.IdentifiedByQuery(cycle, q, rewriting_index, renamings[0])]
-    rules += [templates.NQuery(atom, cycle, q, rewriting_index, renamings[0]) for atom in cycle]
-    rules += [templates.TQuery(cycle, q, rewriting_index, renamings[0])]
-    return rules
+        yield templates.LowerSingleQuery(cycle, q, rewriting_index, renamings)
+    yield templates.IdentifiedByQuery(cycle, q, rewriting_index, renamings[0])
+    for atom in cycle:
+        yield templates.NQuery(atom, cycle, q, rewriting_index, renamings[0])
+    yield templates.TQuery(cycle, q, rewriting_index, renamings[0])
 
 
 def saturate(q: structures.ConjunctiveQuery, bad_fd: FrozenSet[structures.FunctionalDependency]) \
@@ -190,17 +464,52 @@ def saturate(q: structures.ConjunctiveQuery, bad_fd: FrozenSet[structures.Functi
     :param bad_fd:      Set of internal FD that makes q non saturated
     :return:            The saturated query and a set of Datalog rules.
     """
+    return saturated_query(q, bad_fd), saturation_rules(q, bad_fd)
+
+
+def saturation_atom(fd: structures.FunctionalDependency, n_index: int) -> structures.Atom:
+    """
+    Returns the atom added to saturate a query for a given bad internal FD
+    :param fd:          A bad internal FD
+    :param n_index:     Index used to name the atom
+    :return:            The new Atom
+    """
+    return structures.Atom("N_" + str(n_index), list(fd.left) + [fd.right])
+
+
+@phase("saturate.query")
+def saturated_query(q: structures.ConjunctiveQuery, bad_fd: FrozenSet[structures.FunctionalDependency]) \
+        -> structures.ConjunctiveQuery:
+    """
+    Returns the saturated query (See saturate)
+    :param q:           A non saturated ConjunctiveQuery.
+    :param bad_fd:      Set of internal FD that makes q non saturated
+    :return:            The saturated query
+    """
+    n_index = 0
+    new_q = q
+    for fd in bad_fd:
+        fd_set = structures.FunctionalDependencySet([fd])
+        new_q = q.add_atom(saturation_atom(fd, n_index), fd_set, [True] * len(fd.left) + [False], True)
+    return new_q
+
+
+@phase("saturate")
+def saturation_rules(q: structures.ConjunctiveQuery, bad_fd: FrozenSet[structures.FunctionalDependency]) \
+        -> List[structures.DatalogQuery]:
+    """
+    Generates the Datalog rules defining the atoms added by the saturation (See saturate)
+    :param q:           A non saturated ConjunctiveQuery.
+    :param bad_fd:      Set of internal FD that makes q non saturated
+    :return:            A set of Datalog rules.
+    """
     n_index = 0
     atoms = q.get_atoms()
     output = []
-    new_q = q
     for fd in bad_fd:
-        content = list(fd.left) + [fd.right]
-        n_atom = structures.Atom("N_" + str(n_index), content)
-        fd_set = structures.FunctionalDependencySet()
-        fd_set.add(fd)
-        new_q = q.add_atom(n_atom, fd_set, [True] * len(fd.left) + [False], True)
-        valuation = algorithms.generate_renaming(1, list(new_q.get_all_variables()))[0]
+        n_atom = saturation_atom(fd, n_index)
+        content = n_atom.content
+        valuation = algorithms.generate_renaming(1, list(q.get_all_variables().union(n_atom.variables())))[0]
         n_rule = structures.DatalogQuery(n_atom)
         for atom in atoms:
             n_rule.add_atom(atom)
@@ -214,4 +523,4 @@ def saturate(q: structures.ConjunctiveQuery, bad_fd: FrozenSet[structures.Functi
             bad_rule.add_atom(structures.EqualityAtom(var, valuation[var]))
         bad_rule.add_atom(structures.EqualityAtom(fd.right, valuation[fd.right], True))
         output += [n_rule, bad_rule]
-    return new_q, output
+    return output
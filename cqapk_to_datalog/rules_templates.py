@@ -1,5 +1,6 @@
 from cqapk_to_datalog.data_structures import DatalogQuery, Atom, EqualityAtom, CompareAtom, ConjunctiveQuery, AtomValue
 from cqapk_to_datalog.algorithms import apply_renaming_to_atom, apply_renaming_to_atom_values, generate_new_variables
+from cqapk_to_datalog.instrumentation import phase
 from typing import List, Set, Tuple, Dict
 
 
@@ -71,7 +72,7 @@ class FORewritingQuery(DatalogQuery):
                     not isinstance(atoms[k], Atom) or self.neg[atoms[k]] or var not in atoms[k].content):
                 k += 1
             if k == len(atoms):
-                for atom in q.get_atoms():
+                for atom in q.get_atoms_containing(var):
                     content = atom.content
                     if var in content:
                         new_vars = generate_new_variables("F", len(content) - 1, i)
@@ -83,14 +84,14 @@ class FORewritingQuery(DatalogQuery):
                                 j += 1
                             else:
                                 new_content.append(var)
-                        new_atom = Atom(atom.name, new_content)
-                        new_atom.released = set(new_content).intersection(self.head.content)
+                        new_atom = Atom(atom.name, new_content, set(new_content).intersection(self.head.content))
                         self.add_atom(new_atom)
                         break
             i += 1
 
 
 class RewriteAtomQuery(FORewritingQuery):
+    @phase("template.RewriteAtomQuery")
     def __init__(self, data: RewritingData):
         if data.index == 0:
             name = "CERTAINTY"
@@ -109,12 +110,12 @@ class RewriteAtomQuery(FORewritingQuery):
 
 
 class BadBlockQuery(FORewritingQuery):
+    @phase("template.BadBlockQuery")
     def __init__(self, data: RewritingData):
-        head = Atom("BadBlock_" + str(data.index), data.frozen + data.vars_x)
-        head.released = set(data.frozen + data.vars_x)
+        head = Atom("BadBlock_" + str(data.index), data.frozen + data.vars_x, data.frozen + data.vars_x)
         FORewritingQuery.__init__(self, head, data.done)
-        z_atom = Atom(data.atom.name, data.x + data.vars_z)
-        z_atom.released = set(data.frozen + data.vars_x).intersection(set(z_atom.content))
+        z_content = data.x + data.vars_z
+        z_atom = Atom(data.atom.name, z_content, set(data.frozen + data.vars_x).intersection(z_content))
         self.add_atom(z_atom)
         if data.has_c:
             self.add_atom(Atom("GoodFact_" + str(data.index), data.frozen + data.vars_x + data.vars_z), True)
@@ -124,12 +125,13 @@ class BadBlockQuery(FORewritingQuery):
 
 
 class GoodFactQuery(FORewritingQuery):
+    @phase("template.GoodFactQuery")
     def __init__(self, data: RewritingData):
-        head = Atom("GoodFact_" + str(data.index), data.frozen + data.vars_x + data.vars_z)
-        head.released = set(data.frozen + data.vars_x + data.vars_z)
+        head_content = data.frozen + data.vars_x + data.vars_z
+        head = Atom("GoodFact_" + str(data.index), head_content, head_content)
         FORewritingQuery.__init__(self, head, data.done)
-        z_atom = Atom(data.atom.name, data.x + data.vars_z)
-        z_atom.released = set(data.frozen + data.vars_x + data.vars_z).intersection(set(z_atom.content))
+        z_content = data.x + data.vars_z
+        z_atom = Atom(data.atom.name, z_content, set(head_content).intersection(z_content))
         self.add_atom(z_atom)
         for val in data.c:
             ea = EqualityAtom(val, data.c[val])
@@ -141,6 +143,7 @@ class GoodFactQuery(FORewritingQuery):
 
 
 class EqQuery(DatalogQuery):
+    @phase("template.EqQuery")
     def __init__(self, atom, q):
         _, x, _ = q.decompose_atom(atom)
         head_atom = Atom("Eq_" + atom.name, x * 2)
@@ -149,6 +152,7 @@ class EqQuery(DatalogQuery):
 
 
 class NeqQuery(DatalogQuery):
+    @phase("template.NeqQuery")
     def __init__(self, atom, q, renaming):
         v, x, _ = q.decompose_atom(atom)
         renamed_x = apply_renaming_to_atom_values(x, renaming)
@@ -162,6 +166,7 @@ class NeqQuery(DatalogQuery):
 
 
 class RelevantQuery(DatalogQuery):
+    @phase("template.RelevantQuery")
     def __init__(self, atom, q):
         head_atom = Atom("Rlvant_" + atom.name, atom.content)
         DatalogQuery.__init__(self, head_atom)
@@ -170,6 +175,7 @@ class RelevantQuery(DatalogQuery):
 
 
 class GarbageRelevantQuery(DatalogQuery):
+    @phase("template.GarbageRelevantQuery")
     def __init__(self, atom, q):
         _, x, _ = q.decompose_atom(atom)
         head_atom = Atom("Garbage_" + atom.name, x)
@@ -180,6 +186,7 @@ class GarbageRelevantQuery(DatalogQuery):
 
 
 class Any1EmbQuery(DatalogQuery):
+    @phase("template.Any1EmbQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -200,6 +207,7 @@ class Any1EmbQuery(DatalogQuery):
 
 
 class Rel1EmbQuery(DatalogQuery):
+    @phase("template.Rel1EmbQuery")
     def __init__(self, cycle, q, rewriting_index):
         head_content = []
         for atom in cycle:
@@ -213,6 +221,7 @@ class Rel1EmbQuery(DatalogQuery):
 
 
 class Irr1EmbQuery(DatalogQuery):
+    @phase("template.Irr1EmbQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -229,6 +238,7 @@ class Irr1EmbQuery(DatalogQuery):
 
 
 class Garbage1EmbQuery(DatalogQuery):
+    @phase("template.Garbage1EmbQuery")
     def __init__(self, atom, cycle, q, rewriting_index, renamings):
         index = cycle.index(atom)
         k = len(cycle)
@@ -243,6 +253,7 @@ class Garbage1EmbQuery(DatalogQuery):
 
 
 class PkQuery(DatalogQuery):
+    @phase("template.PkQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -269,6 +280,7 @@ class PkQuery(DatalogQuery):
 
 
 class DConRecQuery(DatalogQuery):
+    @phase("template.DConRecQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -299,6 +311,7 @@ class DConRecQuery(DatalogQuery):
 
 
 class DConBaseQuery(DatalogQuery):
+    @phase("template.DConBaseQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -319,6 +332,7 @@ class DConBaseQuery(DatalogQuery):
 
 
 class InLongDCycleQuery(DatalogQuery):
+    @phase("template.InLongDCycleQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         k = len(cycle)
         head_content = []
@@ -334,6 +348,7 @@ class InLongDCycleQuery(DatalogQuery):
 
 
 class GarbageLongCycleQuery(DatalogQuery):
+    @phase("template.GarbageLongCycleQuery")
     def __init__(self, atom, cycle, q, rewriting_index):
         _, x, y = q.decompose_atom(atom)
         head_atom = Atom("Garbage_" + atom.name, x)
@@ -346,6 +361,7 @@ class GarbageLongCycleQuery(DatalogQuery):
 
 
 class GarbagePropagateQuery(DatalogQuery):
+    @phase("template.GarbagePropagateQuery")
     def __init__(self, atom1, atom2, q):
         _, x1, _ = q.decompose_atom(atom1)
         _, x2, _ = q.decompose_atom(atom2)
@@ -357,6 +373,7 @@ class GarbagePropagateQuery(DatalogQuery):
 
 
 class KeepQuery(DatalogQuery):
+    @phase("template.KeepQuery")
     def __init__(self, atom, q):
         _, x, y = q.decompose_atom(atom)
         head_atom = Atom("Keep_" + atom.name, x + y)
@@ -366,6 +383,7 @@ class KeepQuery(DatalogQuery):
 
 
 class LinkQuery(DatalogQuery):
+    @phase("template.LinkQuery")
     def __init__(self, atom, cycle, q, rewriting_index, renaming):
         k = len(cycle)
         _, x_0, _ = q.decompose_atom(cycle[0])
@@ -384,6 +402,7 @@ class LinkQuery(DatalogQuery):
 
 
 class TransBaseQuery(DatalogQuery):
+    @phase("template.TransBaseQuery")
     def __init__(self, cycle, q, rewriting_index, renaming):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_ren = apply_renaming_to_atom_values(x_0, renaming)
@@ -392,6 +411,7 @@ class TransBaseQuery(DatalogQuery):
 
 
 class TransRecQuery(DatalogQuery):
+    @phase("template.TransRecQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_0 = apply_renaming_to_atom_values(x_0, renamings[0])
@@ -402,6 +422,7 @@ class TransRecQuery(DatalogQuery):
 
 
 class LowerSingleQuery(DatalogQuery):
+    @phase("template.LowerSingleQuery")
     def __init__(self, cycle, q, rewriting_index, renamings):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_0 = apply_renaming_to_atom_values(x_0, renamings[0])[0]
@@ -414,6 +435,7 @@ class LowerSingleQuery(DatalogQuery):
 
 
 class LowerCompositeQuery(DatalogQuery):
+    @phase("template.LowerCompositeQuery")
     def __init__(self, cycle, q, index, rewriting_index, renamings):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_0 = apply_renaming_to_atom_values(x_0, renamings[0])
@@ -427,6 +449,7 @@ class LowerCompositeQuery(DatalogQuery):
 
 
 class IdentifiedByQuery(DatalogQuery):
+    @phase("template.IdentifiedByQuery")
     def __init__(self, cycle, q, rewriting_index, renaming):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_ren = apply_renaming_to_atom_values(x_0, renaming)
@@ -436,6 +459,7 @@ class IdentifiedByQuery(DatalogQuery):
 
 
 class TQuery(DatalogQuery):
+    @phase("template.TQuery")
     def __init__(self, cycle, q, rewriting_index, renaming):
         _, x_0, _ = q.decompose_atom(cycle[0])
         x_0_ren = apply_renaming_to_atom_values(x_0, renaming)
@@ -453,6 +477,7 @@ class TQuery(DatalogQuery):
 
 
 class NQuery(DatalogQuery):
+    @phase("template.NQuery")
     def __init__(self, atom, cycle, q, rewriting_index, renaming):
         _, x, _ = q.decompose_atom(atom)
         _, x_0, _ = q.decompose_atom(cycle[0])
@@ -464,3 +489,4 @@ class NQuery(DatalogQuery):
             t_atom_content += x
             t_atom_content += y
         self.add_atom(Atom("T_" + str(rewriting_index), t_atom_content))
+
@@ -2,8 +2,6 @@ from cqapk_to_datalog.rewriting import rewrite_fo
 from cqapk_to_datalog.data_structures import DatalogProgram, ConjunctiveQuery, Atom, AtomValue, FunctionalDependency, FunctionalDependencySet, Database
 import statistics
 import random
-import pandas as pd
-import matplotlib.pyplot as plt
 
 
 class TestDatabase(Database):
@@ -143,6 +141,7 @@ def save_data(data, file):
 	"""
 	Saves data to a csv file
 	"""
+	import pandas as pd
 	df = pd.DataFrame(data, columns = ['n_atoms', 'sd_plus_yes', 'sd_minus_yes', 'mean_yes', 'sd_plus_no', 'sd_minus_no', 'mean_no'])
 	df.to_csv(file)
 
@@ -151,6 +150,8 @@ def plot_single_data(file, label1, label2, x, y, title):
 	"""
 	Plot Function
 	"""
+	import pandas as pd
+	import matplotlib.pyplot as plt
 	df = pd.read_csv(file)
 	ax = plt.gca()
 	df.plot(kind='line',x='n_atoms',y='mean_yes',ax=ax, label=label1)
@@ -166,6 +167,8 @@ def plot_double_data(file1, file2, label1, label2, x, y, title1, title2):
 	"""
 	Plot Function
 	"""
+	import pandas as pd
+	import matplotlib.pyplot as plt
 	df1 = pd.read_csv(file1)
 	df2 = pd.read_csv(file2)
 	plt.subplot(1, 2, 1)
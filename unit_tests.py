@@ -1,9 +1,20 @@
 import unittest
-from cqapk_to_datalog.parsers.cq_parser import parse_queries_from_file
+from unittest import mock
+from cqapk_to_datalog.parsers.cq_parser import parse_queries_from_file, parse_query
 from cqapk_to_datalog.parsers.datalog_parser import read_datalog_file
-from cqapk_to_datalog.rewriting import rewrite, saturate
+from cqapk_to_datalog.rewriting import rewrite, saturate, rewrite_fo, reduce_cycle, classify, rewrite_many, \
+    rewrite_iter, write_rewriting
+from cqapk_to_datalog.exceptions import MalformedQuery, NotSelfJoinFreeQuery, CoNPComplete
 import cqapk_to_datalog.data_structures as structures
 import cqapk_to_datalog.algorithms as algorithms
+from cqapk_to_datalog.graph import DiGraph
+from cqapk_to_datalog.canonical import canonicalize
+from cqapk_to_datalog.cache import RewritingCache, DiskCache
+from cqapk_to_datalog.instrumentation import collect_stats
+import cqapk_to_datalog
+import tempfile
+import os
+import benchmarks
 
 
 class ReadCQFileTests(unittest.TestCase):
@@ -36,6 +47,130 @@ class ReadCQFileTests(unittest.TestCase):
         x = structures.AtomValue("X", True)
         self.assertTrue(q.free_vars == [x])
 
+class AtomValueTests(unittest.TestCase):
+    def test_interning(self):
+        x = structures.AtomValue("X", True)
+        self.assertTrue(structures.AtomValue("X", True) is x)
+        self.assertTrue(structures.AtomValue("X", False) is not x)
+        self.assertTrue(structures.AtomValue("X", False) == x)
+        self.assertTrue(hash(structures.AtomValue("X", False)) == hash(x))
+        self.assertTrue(structures.AtomValue("Y", True) != x)
+
+    def test_pickle(self):
+        import pickle
+        x = structures.AtomValue("X", True)
+        self.assertTrue(pickle.loads(pickle.dumps(x)) is x)
+
+    def test_unused_values_released(self):
+        import gc
+        value = structures.AtomValue("Unused_value", True)
+        constant = structures.AtomValue("Unused_value", False)
+        del value
+        gc.collect()
+        self.assertTrue(("Unused_value", True) not in structures._interned_values)
+        self.assertTrue(structures.AtomValue("Unused_value", True) == constant)
+
+class ConjunctiveQueryBuilderTests(unittest.TestCase):
+    def setUp(self):
+        self.q = parse_queries_from_file("unit_tests_files/queries.txt")[7]
+        self.y = structures.AtomValue("Y", True)
+        self.z = structures.AtomValue("Z", True)
+
+    def test_same_as_single_operations(self):
+        r = self.q.get_atom_by_name("R")
+        expected = self.q.remove_atom(r).release_variable(self.y).release_variable(self.z)
+        built = self.q.builder().remove_atom(r).release_variable(self.y).release_variable(self.z).build()
+        self.assertTrue(built == expected)
+        self.assertTrue(built.free_vars == [self.y, self.z])
+        self.assertTrue(list(map(str, built.content)) == list(map(str, expected.content)))
+
+    def test_release_variables(self):
+        w = structures.AtomValue("W", True)
+        expected = self.q.release_variable(self.y).release_variable(self.z).release_variable(w)
+        released = self.q.release_variables([self.y, self.z, self.y, w])
+        self.assertTrue(released == expected)
+        self.assertTrue(released.free_vars == [self.y, self.z, w])
+        for atom in released.get_atoms():
+            self.assertTrue(atom.released == expected.get_atom_by_name(atom.name).released)
+            self.assertTrue(released.get_atom_fd(atom) == expected.get_atom_fd(atom))
+
+    def test_key_projections(self):
+        w = structures.AtomValue("W", True)
+        u = self.q.get_atom_by_name("U")
+        self.assertTrue(isinstance(self.q.content[u], structures.QueryAtom))
+        self.assertTrue(self.q.get_key_vars(u) == [self.y, self.z, w])
+        released = self.q.release_variable(self.z)
+        self.assertTrue(released.get_key_vars(u) == [self.y, w])
+        self.assertTrue(released.get_key_vars(u, True) == [self.y, w])
+        self.assertTrue(released.get_key(u) == [self.y, self.z, w])
+        r = self.q.get_atom_by_name("R")
+        self.assertTrue(released.content[r] is self.q.content[r])
+
+    def test_structural_sharing(self):
+        t_1 = self.q.get_atom_by_name("T_1")
+        new_q = self.q.builder().release_variable(self.y).build()
+        self.assertTrue(new_q.get_atom_fd(t_1) is self.q.get_atom_fd(t_1))
+        self.assertTrue(new_q.get_atom_by_name("T_1") is t_1)
+        self.assertTrue(new_q.get_atom_by_name("R") is not self.q.get_atom_by_name("R"))
+
+class AtomTests(unittest.TestCase):
+    def setUp(self):
+        self.x = structures.AtomValue("X", True)
+        self.y = structures.AtomValue("Y", True)
+        self.a = structures.AtomValue("a", False)
+        self.atom = structures.Atom("R", [self.x, self.a, self.y], {self.y})
+
+    def test_partitions(self):
+        self.assertTrue(self.atom.variables() == (self.x,))
+        self.assertTrue(self.atom.all_variables() == (self.x, self.y))
+        self.assertTrue(self.atom.constants() == (self.a, self.y))
+        self.assertTrue(self.atom.released == frozenset({self.y}))
+        self.assertTrue(str(self.atom) == "R(X,a,Y)" and str(structures.Atom("CERTAINTY", [])) == "CERTAINTY")
+
+    def test_pickle(self):
+        import pickle
+        copy = pickle.loads(pickle.dumps(self.atom))
+        self.assertTrue(copy == self.atom and hash(copy) == hash(self.atom))
+        self.assertTrue(copy.released == self.atom.released)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.atom.name = "S"
+        with self.assertRaises(AttributeError):
+            del self.atom.content
+        self.assertTrue(self.atom.name == "R" and str(self.atom) == "R(X,a,Y)")
+
+class GraphTests(unittest.TestCase):
+    def setUp(self):
+        self.g = DiGraph(["a", "b", "c", "d"])
+        for source, target in [("a", "b"), ("b", "a"), ("b", "c"), ("c", "d"), ("d", "c")]:
+            self.g.add_edge(source, target)
+
+    def test_components(self):
+        components = self.g.strongly_connected_components()
+        self.assertTrue(sorted(map(sorted, components)) == [["a", "b"], ["c", "d"]])
+        self.assertTrue(self.g.initial_strong_components() == [{"a", "b"}])
+        self.assertTrue(sorted(map(sorted, self.g.simple_cycles())) == [["a", "b"], ["c", "d"]])
+
+    def test_in_degree(self):
+        self.assertTrue(self.g.in_degree("c") == 2)
+        self.g.remove_node("b")
+        self.assertTrue(self.g.in_degree("a") == 0 and self.g.in_degree("c") == 1 and len(self.g) == 3)
+        self.assertTrue(self.g.edges == {("c", "d"), ("d", "c")})
+        self.assertTrue(sorted(self.g.find_cycle()) == ["c", "d"])
+
+    def test_to_networkx(self):
+        nx_graph = self.g.to_networkx()
+        self.assertTrue(set(nx_graph.edges) == self.g.edges)
+
+
+class ImportTimeTests(unittest.TestCase):
+    def test_import_budget(self):
+        total, heavy = benchmarks.bench_import_time()
+        self.assertTrue(heavy == [])
+        self.assertTrue(total < benchmarks.IMPORT_TIME_BUDGET)
+
+
 class ReadDatalogFileTests(unittest.TestCase):
     def setUp(self):
         self.program = read_datalog_file("unit_tests_files/query_1.dlog")
@@ -76,6 +211,41 @@ class TestAlgosSimpleQuery(unittest.TestCase):
         self.assertTrue(algorithms.transitive_closure({self.y}, self.q.get_all_fd()) == {self.y, self.z})
         self.assertTrue(algorithms.transitive_closure({self.z}, self.q.get_all_fd()) == {self.z})
 
+    def test_compiled_closure(self):
+        compiled = self.q.get_compiled_fd()
+        self.assertTrue(compiled is self.q.get_compiled_fd())
+        self.assertTrue(compiled.closure({self.x}) == {self.x, self.y, self.z})
+        self.assertTrue(compiled.closure({self.z}) == {self.z})
+        mask = compiled.closure_mask(compiled.mask([self.y]))
+        self.assertTrue(compiled.variables(mask) == {self.y, self.z})
+        self.assertTrue(self.q.get_compiled_fd(True).closure({self.x}) == {self.x})
+
+    def test_batched_closures(self):
+        compiled = self.q.get_compiled_fd()
+        masks = [compiled.mask(variables) for variables in [[self.x], [self.y], [self.z], [], [self.x, self.z]]]
+        self.assertTrue(compiled.closure_masks(masks) == [compiled.closure_mask(mask) if mask else 0 for mask in masks])
+
+    def test_closure_excluding_atom(self):
+        compiled = self.q.get_compiled_fd()
+        for atom in self.q.get_atoms():
+            for var in [self.x, self.y, self.z]:
+                expected = algorithms.transitive_closure({var}, self.q.get_all_fd(atom))
+                self.assertTrue(compiled.closure({var}, atom) == expected)
+        self.assertTrue(compiled.closure({self.x}, self.r) == {self.x})
+
+    def test_fd_set_builder(self):
+        fd_set = structures.FunctionalDependencySet()
+        fds = [structures.FunctionalDependency([self.x], self.y), structures.FunctionalDependency([self.y], self.z)]
+        for fd in fds:
+            fd_set.add(fd)
+        fd_set.add(fds[0])
+        self.assertTrue(fd_set.set == frozenset(fds))
+        fd_set.remove(fds[1])
+        self.assertTrue(fd_set == structures.FunctionalDependencySet([fds[0]]))
+        self.assertTrue(structures.FunctionalDependencySet.union_all([fd_set, self.q.get_all_fd()]) == self.q.get_all_fd())
+        self.assertTrue(self.q.get_all_fd().set is self.q.get_all_fd().set)
+        self.assertTrue(self.q.get_all_fd(self.r) == self.q.get_atom_fd(self.s))
+
     def test_plus(self):
         self.assertTrue(algorithms.atom_plus(self.r, self.q) == {self.x})
         self.assertTrue(algorithms.atom_plus(self.s, self.q) == {self.y})
@@ -84,6 +254,15 @@ class TestAlgosSimpleQuery(unittest.TestCase):
         a_graph = algorithms.gen_attack_graph(self.q)
         self.assertTrue(len(a_graph.edges) == 1 and (self.r, self.s) in a_graph.edges)
 
+    def test_incidence_index(self):
+        self.assertTrue(set(self.q.get_atoms_with_variable(self.y)) == {self.r, self.s})
+        self.assertTrue(self.q.get_atoms_with_variable(self.z) == (self.s,))
+        released = self.q.release_variable(self.y)
+        self.assertTrue(set(released.get_atoms_with_variable(self.y)) == set())
+        self.assertTrue(set(released.get_atoms_containing(self.y)) == {self.r, self.s})
+        self.assertTrue(algorithms.attacked_atoms(self.r, self.q) == {self.r, self.s})
+        self.assertTrue(algorithms.attacked_atoms(self.s, self.q) == {self.s})
+
     def test_m_graph(self):
         m_graph = algorithms.gen_m_graph(self.q)
         self.assertTrue(len(m_graph.edges) == 1 and (self.r,self.s) in m_graph.edges)
@@ -100,6 +279,10 @@ class TestAlgosSimpleQuery(unittest.TestCase):
         self.assertTrue(algorithms.atom_attacks_variables(self.s, self.y, self.q) is False)
         self.assertTrue(algorithms.atom_attacks_variables(self.s, self.z, self.q) is True)
 
+    def test_attacked_variables(self):
+        attacks = algorithms.attacked_variables(self.q)
+        self.assertTrue(attacks == {self.r: {self.y, self.z}, self.s: {self.z}})
+
 
 class TestAlgosReducibleQuery(unittest.TestCase):
     def setUp(self):
@@ -121,6 +304,31 @@ class TestAlgosReducibleQuery(unittest.TestCase):
         a_graph = algorithms.gen_attack_graph(self.q)
         red = algorithms.get_reductible_sets(self.q, a_graph)
         self.assertTrue(red == [[self.r, self.s]] or red == [[self.s, self.r]])
+        cycle = algorithms.get_reductible_set(self.q, a_graph)
+        self.assertTrue(cycle == [self.r, self.s] or cycle == [self.s, self.r])
+        self.assertTrue(next(algorithms.iter_reductible_sets(self.q, a_graph)) in red)
+
+    def test_strong_cycle(self):
+        conp = parse_queries_from_file("unit_tests_files/queries.txt")[6]
+        self.assertFalse(algorithms.all_cycles_weak(algorithms.gen_attack_graph(conp), conp))
+        dense = benchmarks.dense_scc_query(8)
+        a_graph = algorithms.gen_attack_graph(dense)
+        self.assertTrue(len(a_graph.edges) == 8 * 7)
+        self.assertTrue(algorithms.all_cycles_weak(a_graph, dense))
+
+    def test_attack_graph_update(self):
+        q = self.q
+        a_graph = algorithms.gen_attack_graph(q)
+        q, _ = reduce_cycle(algorithms.get_reductible_sets(q, a_graph)[0], q, 0)
+        while len(q.get_atoms()) > 0:
+            a_graph.update(q)
+            fresh = algorithms.gen_attack_graph(q)
+            self.assertTrue(set(a_graph.nodes) == set(fresh.nodes) and set(a_graph.edges) == set(fresh.edges))
+            self.assertTrue(all(a_graph.plus[atom] == fresh.plus[atom] for atom in q.get_atoms()))
+            atom = [atom for atom in q.get_atoms() if a_graph.in_degree(atom) == 0][0]
+            q, _ = rewrite_fo(q, atom, len(q.get_atoms()) == 1, set(), 0)
+        a_graph.update(q)
+        self.assertTrue(len(a_graph.nodes) == 0)
 
 class TestAlgosSaturatedQuery(unittest.TestCase):
     def setUp(self):
@@ -137,6 +345,9 @@ class TestAlgosSaturatedQuery(unittest.TestCase):
         sp2 = structures.SequentialProof(self.fd, [self.t2])
         sps = algorithms.sequential_proofs(self.fd, self.q)
         self.assertTrue(sps == [sp1, sp2] or sps == [sp2, sp1])
+        first = algorithms.sequential_proofs(self.fd, self.q, lambda sp: True)
+        self.assertTrue(first == [sp1] or first == [sp2])
+        self.assertTrue(algorithms.sequential_proofs(self.fd, self.q, lambda sp: False) == [])
 
     def test_is_internal(self):
         self.assertTrue(algorithms.fd_is_internal(self.fd, self.q))
@@ -145,6 +356,17 @@ class TestAlgosSaturatedQuery(unittest.TestCase):
         self.assertTrue(len(algorithms.find_bad_internal_fd(self.q)) > 0)
         self.assertTrue(len(algorithms.find_bad_internal_fd(self.other)) == 0)
 
+    def test_bad_internal_fd_counters(self):
+        with collect_stats() as stats:
+            bad = algorithms.find_bad_internal_fd(self.q)
+        counters = stats.counters
+        self.assertTrue(bad == frozenset([self.fd]) and counters["find_bad_internal_fd.bad"] == 1)
+        n_lefts = len(set(fd.left for fd in self.q.get_all_fd().set))
+        n_rights = len(set(fd.right for fd in self.q.get_all_fd().set))
+        tests = ["closure", "in_atom", "internal", "bad"]
+        self.assertTrue(sum(counters["find_bad_internal_fd." + key] for key in tests) == n_lefts * n_rights)
+        self.assertTrue(algorithms.find_bad_internal_fd(self.q, algorithms.gen_attack_graph(self.q)) == bad)
+
 class SaturationTests(unittest.TestCase):
     def setUp(self):
         self.q = parse_queries_from_file("unit_tests_files/queries.txt")[7]
@@ -182,6 +404,162 @@ class FOTests(unittest.TestCase):
     def test_consistent_rewrite(self):
         self.query_compare(4)
 
+class ClassificationTests(unittest.TestCase):
+    def setUp(self):
+        self.queries = parse_queries_from_file("unit_tests_files/queries.txt")
+
+    def test_classify(self):
+        r = structures.Atom("R", [structures.AtomValue("X", True), structures.AtomValue("Y", True)])
+        s = structures.Atom("S", [structures.AtomValue("Y", True), structures.AtomValue("Z", True)])
+        fo = classify(self.queries[0])
+        self.assertTrue(fo == structures.Classification(structures.Classification.FO, [r, s], []))
+        self.assertTrue(classify(self.queries[6]).complexity == structures.Classification.CONP_COMPLETE)
+        with mock.patch.object(structures.DatalogQuery, "__init__", side_effect=AssertionError):
+            reducible = classify(self.queries[5])
+            saturated = classify(self.queries[7])
+        self.assertTrue(reducible.complexity == structures.Classification.L and len(reducible.cycles) == 1)
+        self.assertTrue(set(reducible.cycles[0]) == set(self.queries[5].get_atoms()))
+        self.assertTrue(saturated.complexity == structures.Classification.L)
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.q = parse_query("[]:R([X],Y),S([Y],Z)")
+        self.renamed = parse_query("[]:B([V],W),A([U],V)")
+
+    def test_canonical_form(self):
+        self.assertTrue(canonicalize(self.q).key == canonicalize(self.renamed).key)
+        self.assertTrue(canonicalize(self.q).key != canonicalize(parse_query("[X]:R([X],Y),S([Y],Z)")).key)
+        canonical_q = canonicalize(self.renamed)
+        self.assertTrue(set(map(canonical_q.restore_atom, canonical_q.query.get_atoms())) == self.renamed.get_atoms())
+
+    def test_cache_hit(self):
+        cache = RewritingCache()
+        self.assertTrue(rewrite(self.q, cache) == rewrite(self.q))
+        self.assertTrue(rewrite(self.renamed, cache) == rewrite(self.renamed))
+        self.assertTrue(cache.hits == 1 and cache.misses == 1 and len(cache) == 1)
+
+    def test_eviction(self):
+        cache = RewritingCache(1)
+        rewrite(self.q, cache)
+        rewrite(parse_query("[X]:R([X],Y),S([Y],Z)"), cache)
+        rewrite(self.renamed, cache)
+        self.assertTrue(cache.hits == 0 and cache.misses == 3 and len(cache) == 1)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            cache = DiskCache(path)
+            self.assertTrue(rewrite(self.q, cache) == rewrite(self.q))
+            cache.close()
+            cache = DiskCache(path)
+            self.assertTrue(rewrite(self.renamed, cache) == rewrite(self.renamed))
+            self.assertTrue(cache.hits == 1 and cache.misses == 0 and len(cache) == 1)
+            cache.close()
+            with mock.patch.object(cqapk_to_datalog, "__version__", "0"):
+                cache = DiskCache(path)
+                self.assertTrue(len(cache) == 0)
+                cache.close()
+
+    def test_disk_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(os.path.join(directory, "cache.sqlite"))
+            rewrite(self.q, cache)
+            cache.flush()
+            cache.max_size = cache.connection.execute("SELECT SUM(size) FROM rewritings").fetchone()[0]
+            rewrite(parse_query("[X]:R([X],Y),S([Y],Z)"), cache)
+            rewrite(parse_query("[X]:R([X],Y),S([Y],Z)"), cache)
+            self.assertTrue(len(cache) == 1 and cache.hits == 1)
+            cache.close()
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.queries = ["[]:R([X],Y),S([Y],Z)", "[]:R([X],Y),R([Y],Z)", "[]:R([X],Y", "[]:R([X],Y),S([Z],X,Y)",
+                        parse_query("[X]:R([X],Y),S([Y],X)")]
+
+    def check_results(self, results):
+        self.assertTrue([type(result.error) for result in results] ==
+                        [type(None), NotSelfJoinFreeQuery, MalformedQuery, CoNPComplete, type(None)])
+        self.assertTrue(results[0].program == rewrite(parse_query(self.queries[0])))
+        self.assertTrue(results[4].program == rewrite(self.queries[4]))
+
+    def test_rewrite_many(self):
+        self.check_results(list(rewrite_many(self.queries)))
+
+    def test_rewrite_many_spawn(self):
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.check_results(list(rewrite_many(self.queries, workers=2, cache=RewritingCache(), context=context)))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(os.path.join(directory, "cache.sqlite"))
+            self.check_results(list(rewrite_many(self.queries, workers=2, cache=cache, context=context)))
+            self.assertTrue(len(cache) == 2)
+            cache.close()
+
+    def test_json_output(self):
+        import json
+        import batch_rewriting
+        records = [json.loads(batch_rewriting.format_json(result)) for result in rewrite_many(self.queries)]
+        self.assertTrue([record["classification"] for record in records] == ["FO", None, None, "coNP-complete", "FO"])
+        self.assertTrue(records[0]["rules"] == len(records[0]["program"]) and records[0]["time"] >= 0)
+        self.assertTrue(records[4]["free_variables"] == ["X"] and records[2]["error"] is not None)
+
+    def test_complexity_with_cache(self):
+        q = parse_queries_from_file("unit_tests_files/queries.txt")[5]
+        cache = RewritingCache()
+        results = list(rewrite_many([q, q], cache=cache))
+        self.assertTrue(cache.hits == 1 and classify(q).complexity == structures.Classification.L)
+        self.assertTrue([result.complexity for result in results] == [structures.Classification.L] * 2)
+
+    def test_rewrite_many_workers(self):
+        self.check_results(list(rewrite_many(self.queries * 3, workers=2))[5:10])
+
+
+class RewriteIterTests(unittest.TestCase):
+    def setUp(self):
+        self.q = parse_queries_from_file("unit_tests_files/queries.txt")[5]
+
+    def test_rewrite_iter(self):
+        rules = rewrite_iter(self.q)
+        self.assertTrue(isinstance(next(rules), structures.DatalogQuery))
+        self.assertTrue(structures.DatalogProgram(list(rewrite_iter(self.q))) == rewrite(self.q))
+
+    def test_write_rewriting(self):
+        import io
+        sink = io.StringIO()
+        n_rules = write_rewriting(self.q, sink)
+        program = rewrite(self.q)
+        self.assertTrue(n_rules == len(program.rules) and sink.getvalue() == str(program))
+
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        self.q = parse_queries_from_file("unit_tests_files/queries.txt")[5]
+
+    def test_collect_stats(self):
+        with collect_stats() as stats:
+            program = rewrite(self.q)
+        rewrite(self.q)
+        templates = sum(n for name, n in stats.calls.items() if name.startswith("template."))
+        self.assertTrue(stats.calls["rewrite"] == 1 and stats.calls["gen_attack_graph"] == 1)
+        self.assertTrue(templates == len(program.rules) and stats.calls["reduce_cycle"] >= 1)
+        self.assertTrue(stats.times["rewrite"] >= stats.times["reduce_cycle"] > 0)
+        self.assertTrue(stats.calls["get_reductible_sets"] == stats.calls["reduce_cycle"])
+        self.assertTrue(stats.counters["closure_mask"] > 0)
+
+    def test_nested_stats(self):
+        with collect_stats() as outer:
+            with collect_stats() as inner:
+                classify(self.q)
+            classify(self.q)
+        self.assertTrue(inner.calls["classify"] == 1 and outer.calls["classify"] == 2)
+        result = next(rewrite_many([self.q], stats=True))
+        self.assertTrue(result.stats.calls["rewrite"] == 1 and "phases" in result.stats.to_dict())
+        result = next(rewrite_many([self.q], cache=RewritingCache(), stats=True))
+        self.assertTrue(result.stats.calls["rewrite"] == 1)
+
+
 class CycleReduceTests(unittest.TestCase):
     def setUp(self):
         self.q = parse_queries_from_file("unit_tests_files/queries.txt")[5]